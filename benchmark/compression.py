@@ -0,0 +1,119 @@
+"""
+Compare transfer size and time of /memberList and websocket messages with and without compression
+
+A local stand-in for mirai-api-http delays each response and frame by its size on the wire,
+to simulate a remote console with limited bandwidth. The wire size of compressed websocket frames
+is estimated by a deflate stream with context takeover, as used by permessage-deflate.
+
+Usage: python benchmark/compression.py [bandwidth_bytes_per_second]
+"""
+import sys
+import asyncio
+import gzip
+import json
+import time
+import zlib
+from aiohttp import web
+from mirai_core import Bot
+
+PORT = 18092
+MEMBERS = 3000
+FRAMES = 200
+
+
+def member_list():
+    return json.dumps({'code': 0, 'msg': '', 'data': [
+        {'id': 10000 + i, 'memberName': f'群成员{i}', 'specialTitle': '', 'permission': 'MEMBER',
+         'joinTimestamp': 1600000000 + i, 'lastSpeakTimestamp': 1600000000 + i, 'muteTimeRemaining': 0,
+         'group': {'id': 1, 'name': 'group', 'permission': 'MEMBER'}} for i in range(MEMBERS)]}).encode('utf-8')
+
+
+def group_message(i):
+    return json.dumps({'syncId': '-1', 'data': {'type': 'GroupMessage', 'messageChain': [
+        {'type': 'Source', 'id': i, 'time': 1600000000},
+        {'type': 'Plain', 'text': f'message {i} ' + '这是一条比较长的消息。' * 20}],
+        'sender': {'id': 2, 'memberName': 'member', 'permission': 'MEMBER',
+                   'group': {'id': 1, 'name': 'group', 'permission': 'MEMBER'}}}})
+
+
+class FakeConsole:
+    def __init__(self, bandwidth: int):
+        self.bandwidth = bandwidth
+        self.transferred = 0
+        self.body = member_list()
+        self.app = web.Application()
+        self.app.router.add_get('/memberList', self.member_list)
+        self.app.router.add_get('/all', self.websocket)
+
+    async def member_list(self, request):
+        headers = {'Content-Type': 'application/json'}
+        body = self.body
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.transferred += len(body)
+        await asyncio.sleep(len(body) / self.bandwidth)
+        return web.Response(body=body, headers=headers)
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse(compress=True)
+        await ws.prepare(request)
+        deflate = zlib.compressobj(wbits=-15)
+        for i in range(FRAMES):
+            frame = group_message(i)
+            size = len(frame.encode('utf-8'))
+            if ws.compress:
+                size = len(deflate.compress(frame.encode('utf-8')) + deflate.flush(zlib.Z_SYNC_FLUSH))
+            self.transferred += size
+            await asyncio.sleep(size / self.bandwidth)
+            await ws.send_str(frame)
+        async for _ in ws:
+            pass
+        return ws
+
+
+async def main(bandwidth: int):
+    console = FakeConsole(bandwidth)
+    runner = web.AppRunner(console.app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', PORT).start()
+    loop = asyncio.get_event_loop()
+    print(f'bandwidth {bandwidth / 1024:.0f} KiB/s, {MEMBERS} members, {FRAMES} websocket messages')
+
+    for compression in (False, True):
+        bot = Bot(1, port=PORT, loop=loop, compression=compression)
+        name = 'compressed' if compression else 'identity'
+
+        console.transferred = 0
+        start = time.perf_counter()
+        await bot.session.get('/memberList')
+        elapsed = time.perf_counter() - start
+        print(f'{name:>10} /memberList: {console.transferred / 1024:8.1f} KiB on wire, '
+              f'{bot.session.bytes_received / 1024:8.1f} KiB decoded, {elapsed * 1000:8.1f} ms')
+
+        console.transferred = 0
+        received = asyncio.Event()
+        count = 0
+
+        async def handler(event):
+            nonlocal count
+            count += 1
+            if count == FRAMES:
+                received.set()
+
+        start = time.perf_counter()
+        websocket = asyncio.ensure_future(bot.create_websocket(handler))
+        await received.wait()
+        elapsed = time.perf_counter() - start
+        stats = bot.session.compression_stats()['websocket']['/all']
+        print(f'{name:>10}   websocket: {console.transferred / 1024:8.1f} KiB on wire, '
+              f'{stats["received"] / 1024:8.1f} K chars decoded, {elapsed * 1000:8.1f} ms (compress={stats["compress"]})')
+        await bot.session.close_websockets()
+        await websocket
+        await bot.session.close()
+
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 1024))
@@ -0,0 +1,87 @@
+"""
+Compare upload bytes and end-to-end send latency with and without ImagePreprocessor
+
+A local stand-in for mirai-api-http receives the uploads, bandwidth is limited to simulate a remote console.
+Requires Pillow.
+
+Usage: python benchmark/image_preprocess.py [bandwidth_bytes_per_second]
+"""
+import sys
+import asyncio
+import os
+import tempfile
+import time
+from aiohttp import web
+from PIL import Image as PILImage
+from mirai_core import Bot
+from mirai_core.image_preprocess import ImagePreprocessor
+from mirai_core.models.Message import Image
+from mirai_core.models.Types import MessageType
+
+PORT = 18090
+
+
+class FakeConsole:
+    def __init__(self, bandwidth: int):
+        self.bandwidth = bandwidth
+        self.uploaded = 0
+        self.app = web.Application()
+        self.app.router.add_post('/uploadImage', self.upload)
+        self.app.router.add_post('/sendGroupMessage', self.send)
+
+    async def upload(self, request):
+        size = len(await request.read())
+        self.uploaded += size
+        await asyncio.sleep(size / self.bandwidth)
+        return web.json_response({'imageId': '{00000000-0000-0000-0000-000000000000}.jpg', 'url': None})
+
+    async def send(self, request):
+        await request.json()
+        return web.json_response({'code': 0, 'msg': '', 'messageId': 1})
+
+
+def make_images(directory: str, count: int):
+    paths = []
+    for i in range(count):
+        image = PILImage.effect_mandelbrot((3000, 2000), (-2 + i * 0.1, -1, 1, 1), 100).convert('RGB')
+        path = os.path.join(directory, f'{i}.png')
+        image.save(path)
+        paths.append(path)
+    return paths
+
+
+async def send_all(bot: Bot, paths):
+    start = time.perf_counter()
+    await bot.send_message(1, MessageType.GROUP, [Image(path=path) for path in paths])
+    return time.perf_counter() - start
+
+
+async def main(bandwidth: int):
+    console = FakeConsole(bandwidth)
+    runner = web.AppRunner(console.app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', PORT).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_images(directory, 4)
+        original = sum(os.path.getsize(path) for path in paths)
+        print(f'{len(paths)} PNG images, {original / 1024:.0f} KiB, bandwidth {bandwidth / 1024:.0f} KiB/s')
+
+        for name, preprocessor in (('original', None),
+                                   ('preprocessed', ImagePreprocessor(os.path.join(directory, 'cache'),
+                                                                      max_size=(1280, 1280))),
+                                   ('cached', None)):
+            bot = Bot(1, port=PORT, loop=asyncio.get_event_loop(), image_preprocessor=preprocessor)
+            if name == 'cached':  # same options, processed images are already cached
+                bot.image_preprocessor = ImagePreprocessor(os.path.join(directory, 'cache'), max_size=(1280, 1280))
+            console.uploaded = 0
+            elapsed = await send_all(bot, paths)
+            print(f'{name:>12}: uploaded {console.uploaded / 1024:8.0f} KiB, send latency {elapsed * 1000:8.1f} ms')
+            if bot.image_preprocessor is not None:
+                bot.image_preprocessor.close()
+            await bot.session.close()
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 1024))
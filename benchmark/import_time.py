@@ -0,0 +1,76 @@
+"""
+Measure import time of mirai_core with "python -X importtime" and compare it with the budget
+
+The budget is tracked per release in import_budget.json (microseconds, best of N runs).
+Exits with status 1 if any statement exceeds its budget.
+
+Usage: python benchmark/import_time.py [runs] [--update]
+    --update records the measurement as the budget for the current version (with 50% headroom)
+"""
+import sys
+import json
+import re
+import subprocess
+from pathlib import Path
+
+WORK_DIR = Path(__file__).parent.parent
+BUDGET_FILE = Path(__file__).parent / 'import_budget.json'
+
+STATEMENTS = [
+    'import mirai_core',
+    'from mirai_core.models import Message',
+    'from mirai_core import Updater',
+    'from mirai_core import Bot, Updater',
+]
+
+
+def get_version() -> str:
+    txt = (WORK_DIR / 'mirai_core' / '__init__.py').read_text('utf-8')
+    return re.findall(r"^__VERSION__ = '(.*)'[\r\n]?$", txt, re.M)[0]
+
+
+def measure(statement: str) -> int:
+    """
+    Run the statement in a fresh interpreter
+
+    :param statement: python import statement
+    :return: cumulative import time in microseconds of everything imported by the statement
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            cwd=WORK_DIR, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    total = 0
+    started = False
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if name.startswith('  '):  # nested import, already counted by its parent
+            continue
+        if started:
+            total += int(cumulative)
+        elif name.strip() == 'site':  # interpreter startup ends with site
+            started = True
+    return total
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 5
+    version = get_version()
+    budgets = json.loads(BUDGET_FILE.read_text('utf-8')) if BUDGET_FILE.exists() else {}
+    budget = budgets.get(version, {})
+
+    results = {statement: min(measure(statement) for _ in range(runs)) for statement in STATEMENTS}
+    exceeded = False
+    for statement, elapsed in results.items():
+        limit = budget.get(statement)
+        status = '' if limit is None else ('OK' if elapsed <= limit else 'OVER BUDGET')
+        exceeded = exceeded or status == 'OVER BUDGET'
+        print(f'{statement:<40} {elapsed / 1000:8.1f} ms  budget: '
+              f'{"-" if limit is None else f"{limit / 1000:.1f} ms"}  {status}')
+
+    if '--update' in sys.argv:
+        budgets[version] = {statement: int(elapsed * 1.5) for statement, elapsed in results.items()}
+        BUDGET_FILE.write_text(json.dumps(budgets, indent=4) + '\n', 'utf-8')
+        print(f'Budget for {version} updated')
+    elif exceeded:
+        sys.exit(1)
@@ -0,0 +1,65 @@
+"""
+Compare memory and parse time of a replayed event stream with and without interning of Group, Member and Friend
+
+The stream is group messages from a fixed set of groups and senders, and the most recent events are kept
+(as a message history would), so that retained memory shows how many entity models are alive.
+
+Usage: python benchmark/intern_entities.py [events] [kept]
+"""
+import sys
+import asyncio
+import random
+import time
+import tracemalloc
+from collections import deque
+from mirai_core import Bot
+
+GROUPS = 20
+SENDERS_PER_GROUP = 100
+
+
+def make_stream(events: int):
+    random.seed(0)
+    stream = []
+    for i in range(events):
+        group_id = random.randrange(GROUPS)
+        sender_id = 10000 + random.randrange(SENDERS_PER_GROUP)
+        stream.append({'syncId': '-1', 'data': {
+            'type': 'GroupMessage',
+            'messageChain': [{'type': 'Source', 'id': i, 'time': 1600000000 + i},
+                             {'type': 'Plain', 'text': f'message {i}'}],
+            'sender': {'id': sender_id, 'memberName': f'member {sender_id}', 'specialTitle': '',
+                       'permission': 'MEMBER', 'joinTimestamp': 0, 'lastSpeakTimestamp': 0, 'muteTimeRemaining': 0,
+                       'group': {'id': 1000 + group_id, 'name': f'group {group_id}', 'permission': 'MEMBER'}}}})
+    return stream
+
+
+def replay(bot: Bot, stream, kept: int):
+    history = deque(maxlen=kept)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for result in stream:
+        history.append(bot._parse_event(result))
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, current, history
+
+
+async def main(events: int, kept: int):
+    stream = make_stream(events)
+    print(f'{events} group messages from {GROUPS} groups x {SENDERS_PER_GROUP} senders, {kept} kept')
+    for trusted in (False, True):
+        for intern_entities in (False, True):
+            bot = Bot(1, trusted=trusted, intern_entities=intern_entities)
+            elapsed, retained, history = replay(bot, stream, kept)
+            senders = len({id(event.sender) for event in history})
+            groups = len({id(event.sender.group) for event in history})
+            name = f'{"trusted" if trusted else "validated"}{", interned" if intern_entities else ""}'
+            print(f'{name:>20}: {elapsed * 1e6 / events:6.1f} us/event, retained {retained / 1024:8.0f} KiB, '
+                  f'{senders} Member and {groups} Group instances alive')
+            await bot.session.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000, int(sys.argv[2]) if len(sys.argv) > 2 else 10000))
@@ -0,0 +1,71 @@
+"""
+Compare time and peak memory of Bot.get_members and Bot.iter_members for a large group
+
+A local stand-in for mirai-api-http serves /memberList.
+
+Usage: python benchmark/iter_members.py [members]
+"""
+import sys
+import asyncio
+import json
+import time
+import tracemalloc
+from aiohttp import web
+from mirai_core import Bot
+
+PORT = 18093
+
+
+def member_list(count: int) -> bytes:
+    return json.dumps({'code': 0, 'msg': '', 'data': [
+        {'id': 10000 + i, 'memberName': f'群成员{i}', 'specialTitle': '', 'permission': 'MEMBER',
+         'joinTimestamp': 1600000000 + i, 'lastSpeakTimestamp': 1600000000 + i, 'muteTimeRemaining': 0,
+         'group': {'id': 1, 'name': 'group', 'permission': 'MEMBER'}} for i in range(count)]}).encode('utf-8')
+
+
+async def main(count: int):
+    body = member_list(count)
+    app = web.Application()
+    app.router.add_get('/memberList', lambda request: web.Response(body=body, content_type='application/json'))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', PORT).start()
+    bot = Bot(1, port=PORT, loop=asyncio.get_event_loop())
+    print(f'{count} members, {len(body) / 1024:.0f} KiB')
+
+    async def get_members(trusted):
+        return len(await bot.get_members(1, trusted=trusted))
+
+    async def iter_members(trusted, compact=False):
+        members = 0
+        async for _ in bot.iter_members(1, trusted=trusted, compact=compact):
+            members += 1
+        return members
+
+    cases = [
+        ('get_members', lambda: get_members(False)),
+        ('get_members trusted', lambda: get_members(True)),
+        ('iter_members', lambda: iter_members(False)),
+        ('iter_members trusted', lambda: iter_members(True)),
+        ('iter_members compact', lambda: iter_members(True, compact=True)),
+    ]
+    for name, case in cases:
+        await case()  # warm up
+        elapsed = float('inf')
+        for _ in range(5):  # time without tracemalloc, which slows down allocations
+            start = time.perf_counter()
+            members = await case()
+            elapsed = min(elapsed, time.perf_counter() - start)
+            assert members == count
+        tracemalloc.start()
+        await case()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:>22}: {elapsed * 1000:8.1f} ms, peak {peak / 1024:8.0f} KiB')
+
+    await bot.session.close()
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000))
@@ -0,0 +1,76 @@
+"""
+Compare queries across all groups on lists of Member and on Roster
+
+Synthetic members are spread over many groups with overlapping membership.
+
+Usage: python benchmark/roster.py [groups] [members_per_group]
+"""
+import sys
+import os
+import random
+import tempfile
+import time
+from mirai_core.models.Entity import Group, Member, Permission
+from mirai_core.roster import Roster
+
+
+def make_members(groups: int, per_group: int):
+    random.seed(0)
+    population = groups * per_group // 4  # members are in 4 groups on average
+    rosters = {}
+    for group_id in range(1, groups + 1):
+        group = Group.construct(id=group_id, name=f'group {group_id}', permission=Permission.Member)
+        permissions = [Permission.Owner] + [Permission.Administrator] * 5 + [Permission.Member] * (per_group - 6)
+        rosters[group_id] = [Member.construct(id=100000 + member_id, memberName=str(member_id),
+                                              permission=permission, group=group)
+                             for member_id, permission in zip(random.sample(range(population), per_group),
+                                                              permissions)]
+    return rosters
+
+
+def measure(name, func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    print(f'{name:>36}: {best * 1000:9.2f} ms')
+    return result
+
+
+def main(groups: int, per_group: int):
+    rosters = make_members(groups, per_group)
+    members = [member for group_members in rosters.values() for member in group_members]
+    print(f'{groups} groups, {len(members)} memberships')
+
+    roster = measure('build Roster', lambda: Roster.from_members(members), repeat=1)
+    roster.columns
+
+    def admins_loop():
+        return [(member.id, member.group.id) for member in members if member.permission != Permission.Member]
+
+    def counts_loop():
+        counts = {}
+        for member in members:
+            counts[member.id] = counts.get(member.id, 0) + 1
+        return [member_id for member_id, count in counts.items() if count > 5]
+
+    def common_loop():
+        return set.intersection(*({member.id for member in rosters[group_id]} for group_id in (1, 2)))
+
+    assert len(measure('admins, Member lists', admins_loop)) == len(measure('admins, Roster', roster.admins)[0])
+    assert len(measure('in more than 5 groups, Member lists', counts_loop)) == \
+        len(measure('in more than 5 groups, Roster', lambda: roster.members_in_groups(more_than=5))[0])
+    assert len(measure('common members, Member lists', common_loop)) == \
+        len(measure('common members, Roster', lambda: roster.common_members([1, 2])))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'roster.npz')
+        measure('save', lambda: roster.save(path), repeat=1)
+        loaded = measure('load', lambda: Roster.load(path))
+        print(f'{"file size":>36}: {os.path.getsize(path) / 1024:9.0f} KiB')
+        assert len(loaded) == len(roster)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 600, int(sys.argv[2]) if len(sys.argv) > 2 else 500)
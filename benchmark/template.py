@@ -0,0 +1,41 @@
+"""
+Compare building a MessageChain from scratch with rendering a precompiled MessageTemplate
+
+Usage: python benchmark/template.py [iterations]
+"""
+import sys
+import json
+import timeit
+from mirai_core.models.Message import MessageChain, Plain, At, Image
+from mirai_core.models.Template import MessageTemplate, Placeholder
+
+IMAGE_ID = '{01E9451B-70ED-EAE3-B37C-101F1EEBF5B5}.jpg'
+
+
+def from_scratch(target: int, points: int):
+    message_chain = MessageChain.parse_obj([
+        At(target=target, display=''),
+        Plain(text=f' you have {points} points'),
+        Image(imageId=IMAGE_ID)
+    ])
+    return json.loads(message_chain.json())
+
+
+template = MessageTemplate([
+    Placeholder('user', 'At'),
+    Plain(text=' you have '),
+    Placeholder('points'),
+    Plain(text=' points'),
+    Image(imageId=IMAGE_ID)
+])
+
+
+def from_template(target: int, points: int):
+    return template.render(user=target, points=points).message_chain
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, func in (('from scratch', from_scratch), ('template', from_template)):
+        elapsed = timeit.timeit(lambda: func(123456, 42), number=iterations)
+        print(f'{name:>12}: {elapsed / iterations * 1e6:8.2f} us/message')
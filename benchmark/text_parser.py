@@ -0,0 +1,109 @@
+"""
+Compare TextParser with regular expressions over the face table for converting long texts into message chains
+
+Usage: python benchmark/text_parser.py [text_length] [members]
+"""
+import sys
+import random
+import re
+import time
+from mirai_core.models.Constant import qq_emoji_text_list
+from mirai_core.models.Message import MessageChain, Plain, Face, At
+from mirai_core.models.Parser import TextParser
+
+
+def make_text(length: int, names):
+    random.seed(0)
+    faces = [text for text in qq_emoji_text_list.values() if text != '[Empty]']
+    parts = []
+    size = 0
+    while size < length:
+        choice = random.random()
+        if choice < 0.1:
+            part = random.choice(faces)
+        elif choice < 0.15:
+            part = '@' + random.choice(names) + ' '
+        else:
+            part = random.choice(['你好', '今天', 'hello', 'hello ', '[不是表情]', '，', '。', 'world ', '@ '])
+        parts.append(part)
+        size += len(part)
+    return ''.join(parts)
+
+
+def parse_regex(text: str, names) -> MessageChain:
+    """
+    Scan the face table and the names with one alternation of all tokens, compiled for each message
+    """
+    faces = {}
+    for face_id, face in qq_emoji_text_list.items():
+        if face != '[Empty]':
+            faces.setdefault(face, face_id)
+    tokens = sorted(list(faces) + ['@' + name for name in names], key=len, reverse=True)
+    pattern = re.compile('|'.join(re.escape(token) if token in faces else  # mentions at word boundaries only
+                                  rf'(?<![A-Za-z0-9_]){re.escape(token)}(?![A-Za-z0-9_])' for token in tokens))
+    components = []
+    last = 0
+    for match in pattern.finditer(text):
+        if match.start() > last:
+            components.append(Plain(text[last:match.start()]))
+        token = match.group()
+        components.append(Face(faces[token]) if token in faces else At(names[token[1:]], display=''))
+        last = match.end()
+    if last < len(text):
+        components.append(Plain(text[last:]))
+    return MessageChain.parse_obj(components)
+
+
+def check_tokens():
+    """
+    Faces win over names of the same text, and names are only matched at word boundaries
+    """
+    parser = TextParser({'Al': 1, 'Alice': 2, '微笑]': 3, 'Bob!': 4, '小明': 5})
+    face = ('Face', parser._faces['[微笑]'])
+    cases = {
+        '@Alice': [('At', 2)],
+        '@Al ice': [('At', 1), ' ice'],
+        '@Alic': ['@Alic'],
+        '@Alice_': ['@Alice_'],
+        '@Alice.': [('At', 2), '.'],
+        'a@Alice.com': ['a@Alice.com'],
+        '你好@Alice你好': ['你好', ('At', 2), '你好'],
+        '@小明你好': [('At', 5), '你好'],
+        '@Bob!x': [('At', 4), 'x'],
+        '@微笑]': [('At', 3)],
+        '[微笑]': [face],
+        'x[微笑]y': ['x', face, 'y'],
+    }
+    for text, expected in cases.items():
+        assert parser.tokenize(text) == expected, (text, parser.tokenize(text))
+    collision = TextParser({'微笑]': 3}, mention_prefix='[')
+    assert collision.tokenize('[微笑]') == [face]
+    collision.update_members({})
+    assert collision.tokenize('[微笑]') == [face]
+
+
+def measure(name, func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    print(f'{name:>28}: {best * 1000:9.2f} ms')
+    return result
+
+
+def main(length: int, members: int):
+    names = {f'member{i}': 10000 + i for i in range(members)}
+    check_tokens()
+    text = make_text(length, list(names))
+    print(f'{len(text)} characters, {members} member names')
+    regex_chain = measure('regex', lambda: parse_regex(text, names))
+    parser = measure('compile TextParser', lambda: TextParser(names))
+    measure('TextParser.tokenize', lambda: parser.tokenize(text))
+    chain = measure('TextParser.parse', lambda: parser.parse(text))
+    assert [repr(component) for component in chain] == [repr(component) for component in regex_chain]
+    print(f'{len(chain)} components')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, int(sys.argv[2]) if len(sys.argv) > 2 else 500)
@@ -0,0 +1,68 @@
+"""
+Compare full validation with the trusted (construct) path on a 3000-member group list and a message stream
+Both paths are first checked to give the same components, including cards (Json, Xml, App) and Poke
+
+Usage: python benchmark/trusted_parse.py [members]
+"""
+import sys
+import timeit
+from mirai_core.models.Entity import Member
+from mirai_core.models.Event import WebSocketEvent, parse_trusted_event
+
+GROUP = {'id': 123456789, 'name': 'benchmark group', 'permission': 'MEMBER'}
+
+
+def member_list(count: int):
+    return [{'id': 10000 + i, 'memberName': f'member {i}', 'permission': 'MEMBER', 'group': GROUP}
+            for i in range(count)]
+
+
+MESSAGE = {
+    'syncId': '-1',
+    'data': {
+        'type': 'GroupMessage',
+        'messageChain': [
+            {'type': 'Source', 'id': 123456, 'time': 1600000000},
+            {'type': 'At', 'target': 10001, 'display': '@member 1'},
+            {'type': 'Plain', 'text': ' hello world'},
+            {'type': 'Face', 'faceId': 14, 'name': '微笑'},
+        ],
+        'sender': {'id': 10002, 'memberName': 'member 2', 'permission': 'MEMBER', 'group': GROUP}
+    }
+}
+
+CARDS = {
+    **MESSAGE['data'],
+    'messageChain': MESSAGE['data']['messageChain'] + [
+        {'type': 'Json', 'json': '{"app": "com.tencent.miniapp"}'},
+        {'type': 'Xml', 'xml': '<?xml version="1.0"?><msg/>'},
+        {'type': 'App', 'content': '{"prompt": "[share]"}'},
+        {'type': 'Poke', 'name': 'ShowLove'},
+    ]
+}
+
+
+def check_same(data: dict) -> None:
+    validated = WebSocketEvent.parse_obj({'syncId': '-1', 'data': data}).data
+    trusted = parse_trusted_event(data)
+    assert type(trusted) is type(validated)
+    assert len(trusted.messageChain) == len(validated.messageChain)
+    for expected, component in zip(validated.messageChain, trusted.messageChain):
+        assert type(component) is type(expected), (type(component), type(expected))
+        assert component.dict(by_alias=True) == expected.dict(by_alias=True), component
+
+
+if __name__ == '__main__':
+    check_same(MESSAGE['data'])
+    check_same(CARDS)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    members = member_list(count)
+    for name, func in (('parse_obj', Member.parse_obj), ('trusted', Member.parse_trusted)):
+        elapsed = min(timeit.repeat(lambda: [func(m) for m in members], number=1, repeat=5))
+        print(f'{count} members {name:>10}: {elapsed * 1000:8.2f} ms')
+
+    iterations = 2000
+    for name, func in (('parse_obj', lambda: WebSocketEvent.parse_obj(MESSAGE).data),
+                       ('trusted', lambda: parse_trusted_event(MESSAGE['data']))):
+        elapsed = timeit.timeit(func, number=iterations)
+        print(f'GroupMessage {name:>10}: {elapsed / iterations * 1e6:8.2f} us/event')
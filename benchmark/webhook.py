@@ -0,0 +1,101 @@
+"""
+Check WebhookReceiver against a locally bound receiver, and measure the latency of replies in the webhook response
+
+Pushed events are posted as the mirai-api-http webhook adapter does. The event must go through Bot._parse_event
+and Updater.dispatch, and the reply of the handler must come back as the command in the webhook response.
+A handler that replies after reply_timeout falls back to Bot.send_message, answered by a local stand-in console.
+
+Usage: python benchmark/webhook.py [events]
+"""
+import sys
+import asyncio
+import time
+import aiohttp
+from aiohttp import web
+from mirai_core import Bot, Updater
+from mirai_core.models.Event import Message
+from mirai_core.webhook import WebhookReceiver
+
+CONSOLE_PORT = 18096
+WEBHOOK_PORT = 18097
+TOKEN = 'secret'
+
+
+def group_message(i: int, text: str):
+    return {'type': 'GroupMessage',
+            'messageChain': [{'type': 'Source', 'id': i, 'time': 1600000000}, {'type': 'Plain', 'text': text}],
+            'sender': {'id': 2, 'memberName': 'member', 'permission': 'MEMBER',
+                       'group': {'id': 1, 'name': 'group', 'permission': 'MEMBER'}}}
+
+
+async def main(events: int):
+    sent = []
+
+    async def send(request):
+        sent.append(await request.json())
+        return web.json_response({'code': 0, 'msg': '', 'messageId': len(sent)})
+
+    console = web.Application()
+    console.router.add_post('/sendGroupMessage', send)
+    console.router.add_post('/release', lambda request: web.json_response({'code': 0, 'msg': ''}))
+    runner = web.AppRunner(console)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', CONSOLE_PORT).start()
+
+    bot = Bot(1, port=CONSOLE_PORT, loop=asyncio.get_event_loop())
+    webhook = WebhookReceiver(bot, host='127.0.0.1', port=WEBHOOK_PORT, token=TOKEN, reply_timeout=0.2)
+    updater = Updater(bot, webhook=webhook)
+    parsed = 0
+    parse_event = bot._parse_event
+
+    def count_parse(result, trusted=None):
+        nonlocal parsed
+        parsed += 1
+        return parse_event(result, trusted)
+
+    bot._parse_event = count_parse
+
+    @updater.add_handler(Message)
+    async def handler(event):
+        text = str(event.messageChain.get_first(type(event.messageChain[1])))
+        if text == 'late':
+            await asyncio.sleep(0.4)
+        await webhook.reply(event, f're: {text}')
+
+    await webhook.start(updater.dispatch)
+    url = f'http://127.0.0.1:{WEBHOOK_PORT}/'
+    headers = {'Authorization': TOKEN}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=group_message(0, 'ping')) as response:
+            assert response.status == 401, response.status
+
+        async with session.post(url, json=group_message(0, 'ping'), headers=headers) as response:
+            assert response.status == 200, response.status
+            body = await response.json()
+        assert parsed == 1, parsed
+        assert body['command'] == 'sendGroupMessage', body
+        assert body['content']['target'] == 1 and body['content']['messageChain'][0]['text'] == 're: ping', body
+        assert 'sessionKey' not in body['content'], body
+
+        async with session.post(url, json=group_message(1, 'late'), headers=headers) as response:
+            assert response.status == 204, response.status
+        await asyncio.sleep(0.3)
+        assert sent and sent[-1]['messageChain'][0]['text'] == 're: late', sent
+        print('webhook reply, timeout fallback and token check passed')
+
+        latencies = []
+        for i in range(events):
+            start = time.perf_counter()
+            async with session.post(url, json=group_message(i, 'ping'), headers=headers) as response:
+                assert (await response.json())['command'] == 'sendGroupMessage'
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print(f'{events} events replied in webhook response: p50 {latencies[len(latencies) // 2] * 1e6:.0f} us, '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} us')
+
+    await updater.shutdown()
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
@@ -0,0 +1,126 @@
+"""
+Compare latency and throughput of sending messages over http and as websocket commands
+
+A local stand-in for mirai-api-http answers sendGroupMessage both as http endpoint and as websocket command.
+Also checks that a handler of Bot.create_websocket can reply from inside the callback over websocket commands.
+
+Usage: python benchmark/ws_commands.py [messages] [concurrency]
+"""
+import sys
+import asyncio
+import json
+import time
+from aiohttp import web
+from mirai_core import Bot
+from mirai_core.models.Types import MessageType
+
+PORT = 18091
+
+
+class FakeConsole:
+    def __init__(self):
+        self.message_id = 0
+        self.websockets = []
+        self.app = web.Application()
+        self.app.router.add_post('/sendGroupMessage', self.send)
+        self.app.router.add_get('/all', self.websocket)
+
+    def reply(self, data):
+        self.message_id += 1
+        return {'code': 0, 'msg': '', 'messageId': self.message_id}
+
+    async def send(self, request):
+        return web.json_response(self.reply(await request.json()))
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.websockets.append(ws)
+        async for msg in ws:
+            frame = json.loads(msg.data)
+            await ws.send_json({'syncId': frame['syncId'], 'data': self.reply(frame['content'])})
+        return ws
+
+
+async def measure(bot: Bot, messages: int, concurrency: int):
+    latencies = []
+    for i in range(messages):
+        start = time.perf_counter()
+        await bot.send_message(1, MessageType.GROUP, f'message {i}')
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(i):
+        async with semaphore:
+            await bot.send_message(1, MessageType.GROUP, f'message {i}')
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(messages)))
+    throughput = messages / (time.perf_counter() - start)
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], throughput
+
+
+async def reply_from_handler(bot: Bot, console: FakeConsole, messages: int):
+    """
+    Push group messages over the websocket, the handler replies to each one by a websocket command
+    """
+    replied = asyncio.Event()
+    count = 0
+
+    async def handler(event):
+        nonlocal count
+        await bot.send_message(event.sender.group, MessageType.GROUP, 'pong')
+        count += 1
+        if count == messages:
+            replied.set()
+
+    websocket = asyncio.ensure_future(bot.create_websocket(handler))
+    while not bot.session.websockets:
+        await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    for i in range(messages):
+        await console.websockets[-1].send_json({'syncId': '-1', 'data': {
+            'type': 'GroupMessage', 'messageChain': [{'type': 'Source', 'id': i, 'time': 1600000000}],
+            'sender': {'id': 2, 'memberName': 'member', 'permission': 'MEMBER',
+                       'group': {'id': 1, 'name': 'group', 'permission': 'MEMBER'}}}})
+    await asyncio.wait_for(replied.wait(), 5)  # the reply would wait for the command timeout if the reader blocked
+    elapsed = time.perf_counter() - start
+    print(f'{"in handler":>10}: {messages} replies in {elapsed * 1000:.0f} ms')
+    await bot.session.close_websockets()
+    await websocket
+
+
+async def main(messages: int, concurrency: int):
+    console = FakeConsole()
+    runner = web.AppRunner(console.app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', PORT).start()
+    loop = asyncio.get_event_loop()
+
+    print(f'{messages} messages, concurrency {concurrency}')
+    for name, websocket_commands in (('http', False), ('websocket', True)):
+        bot = Bot(1, port=PORT, loop=loop, websocket_commands=websocket_commands)
+        websocket = None
+        if websocket_commands:
+            websocket = asyncio.ensure_future(bot.create_websocket(lambda event: None))
+            while not bot.session.websockets:
+                await asyncio.sleep(0.01)
+        p50, p99, throughput = await measure(bot, messages, concurrency)
+        print(f'{name:>10}: p50 {p50 * 1e6:8.0f} us, p99 {p99 * 1e6:8.0f} us, {throughput:8.0f} messages/s')
+        await bot.session.close_websockets()
+        if websocket is not None:
+            await websocket
+        await bot.session.close()
+
+    bot = Bot(1, port=PORT, loop=loop, websocket_commands=True)
+    await reply_from_handler(bot, console, 100)
+    await bot.session.close()
+
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+                                                     int(sys.argv[2]) if len(sys.argv) > 2 else 32))
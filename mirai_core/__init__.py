@@ -1,6 +1,39 @@
-from .bot import Bot
-from .updater import Updater
-from . import models
-from . import exceptions
+from importlib import import_module
 
 __VERSION__ = '0.10.1'
+
+__all__ = [
+    'Bot',
+    'Updater',
+    'models',
+    'exceptions'
+]
+
+# submodules are imported on first access, so that "import mirai_core" does not load aiohttp and pydantic
+# other submodules (mirai_core.updater, mirai_core.network, ...) are also imported on first attribute access
+_lazy_attributes = {
+    'Bot':        ('.bot', 'Bot'),
+    'Updater':    ('.updater', 'Updater'),
+    'models':     ('.models', None),
+    'exceptions': ('.exceptions', None),
+}
+
+
+def __getattr__(name):
+    if name.startswith('__'):  # probed by tools such as inspect and pickle, never a submodule
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module_name, attribute = _lazy_attributes.get(name, ('.' + name, None))
+    try:
+        value = import_module(module_name, __name__)
+    except ModuleNotFoundError as e:
+        if e.name != __name__ + module_name:  # the submodule exists, but one of its dependencies is missing
+            raise
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    if attribute is not None:
+        value = getattr(value, attribute)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,7 +1,7 @@
-from typing import Union, List, Type, Dict
+from typing import Union, List, Type, Dict, Tuple, AsyncIterator, Iterator
 from datetime import timedelta
 from pathlib import Path
-from pydantic import parse_obj_as
+import asyncio
 import json
 from functools import wraps
 from .log import create_logger
@@ -10,9 +10,15 @@ from .models.Types import NewFriendRequestResponse, MemberJoinRequestResponse
 from .models.Message import BotMessage, MessageChain, \
     Source, Image, Quote, Plain, BaseMessageComponent, FlashImage, At
 from .models.Event import *
-from .models.Entity import Friend, Group, GroupSetting, Member, MemberChangeableSetting
+from .models.Entity import Friend, Group, GroupSetting, Member, MemberChangeableSetting, MemberSummary, Permission, \
+    EntityMap
+from .models.Template import MessageTemplate, RenderedMessage, Placeholder
 from .network import HttpClient
-from .exceptions import AuthenticationException, MiraiException, NetworkException, SessionException
+from .image_cache import ImageFetcher
+from .image_preprocess import ImagePreprocessor
+from .exceptions import AuthenticationException, MiraiException, NetworkException, SessionException, \
+    ImageUploadException, MessageTooLongException, CircuitOpenException, PartialMessageException, \
+    CoalescedMessageException
 
 __ALL__ = [
     'Bot'
@@ -24,31 +30,157 @@ def retry_once(func):
     async def wrapper(self, *args, **kwargs):
         try:
             return await func(self, *args, **kwargs)
-        except (NetworkException, SessionException, AuthenticationException):
+        except CircuitOpenException as e:  # handshake would be rejected as well
+            self.logger.warning(str(e))
+            return None
+        except (NetworkException, SessionException, AuthenticationException, ImageUploadException) as e:
+            if isinstance(e, ImageUploadException) and not e.retryable:
+                raise
             self.logger.exception('Trying handshake due to the following exception')
         try:
             await self.handshake()
             return await func(self, *args, **kwargs)
-        except (NetworkException, SessionException, AuthenticationException):
+        except (NetworkException, SessionException, AuthenticationException, ImageUploadException) as e:
+            if isinstance(e, ImageUploadException) and not e.retryable:
+                raise
             self.logger.exception('Unable to handshake')
         return None
 
     return wrapper
 
 
+class _OutboundBatch:
+    """
+    Internal use only
+    Messages to the same target waiting to be merged
+    """
+
+    def __init__(self, portal: str, data: Dict, separator: str = ''):
+        self.portal = portal
+        self.data = {key: value for key, value in data.items() if key != 'messageChain'}
+        self.quote = data.get('quote')
+        self.separator = [{'type': 'Plain', 'text': separator}] if separator else []
+        self.separator_length = len(json.dumps(self.separator[0], ensure_ascii=False)) + 2 if separator else 0  # ', '
+        self.parts: List[Tuple[List[Dict], asyncio.Future]] = []
+        self.length = 0
+
+    def added_length(self, length: int) -> int:
+        return self.length + (self.separator_length if self.parts else 0) + length
+
+    def add(self, message_chain: List[Dict], length: int) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        self.length = self.added_length(length)
+        self.parts.append((message_chain, future))
+        return future
+
+    def merged_data(self) -> Dict:
+        message_chain = []
+        for message, _ in self.parts:
+            if message_chain:
+                message_chain.extend(self.separator)
+            message_chain.extend(message)
+        return {**self.data, 'messageChain': message_chain}
+
+
+class _BatchHandshake:
+    """
+    Internal use only
+    Send the messages of an outbound batch, retried once after a handshake like retry_once,
+    but with one handshake for the whole batch instead of one for each merged call
+    """
+
+    def __init__(self, bot: 'Bot'):
+        self.bot = bot
+        self.done = False
+        self.error: Optional[Exception] = None
+
+    async def post(self, portal: str, data: Dict) -> BotMessage:
+        bot = self.bot
+        for attempt in range(2):
+            try:
+                result = await bot.session.post(portal, data={**data, 'sessionKey': bot.session_key},
+                                                idempotent=bot.retry_sends)
+                return BotMessage.parse_obj(result)
+            except CircuitOpenException as e:  # handshake would be rejected as well
+                raise CoalescedMessageException(str(e)) from e
+            except (NetworkException, SessionException, AuthenticationException) as e:
+                if attempt:
+                    raise CoalescedMessageException(f'Unable to send message after handshake ({e!r})') from e
+                if not self.done:
+                    bot.logger.exception('Trying handshake due to the following exception')
+            if not self.done:
+                self.done = True
+                try:
+                    await bot.handshake()
+                except (NetworkException, SessionException, AuthenticationException) as e:
+                    bot.logger.exception('Unable to handshake')
+                    self.error = e
+            if self.error is not None:
+                raise CoalescedMessageException(f'Unable to handshake ({self.error!r})') from self.error
+
+
 class Bot:
     """
     See https://github.com/mamoe/mirai-api-http for details
     """
 
-    def __init__(self, qq: int, host: str = '127.0.0.1', port: int = 8080, verify_key: str = 'abcdefgh', loop=None, scheme: str = 'http'):
+    def __init__(self, qq: int, host: str = '127.0.0.1', port: int = 8080, verify_key: str = 'abcdefgh', loop=None,
+                 scheme: str = 'http', trusted: bool = False, max_concurrent_uploads: int = 4,
+                 image_preprocessor: Optional[ImagePreprocessor] = None, coalesce_window: Optional[float] = None,
+                 max_message_length: int = 4500, retry_sends: bool = False, websocket_commands: bool = False,
+                 compression: bool = False, intern_entities: bool = False, split_long_messages: bool = False,
+                 coalesce_separator: str = ''):
+        """
+        Initialize Bot
+
+        :param qq: the qq number of the bot
+        :param host: mirai-api-http host
+        :param port: mirai-api-http port
+        :param verify_key: mirai-api-http verify key
+        :param loop: the event loop
+        :param scheme: 'http' or 'https'
+        :param trusted: bool, whether data from mirai console is trusted.
+               Trusted data skips pydantic validation for rosters and messages (only fields used by this library
+               are converted). Can be changed at any time, set to False to turn full validation back on for debugging
+        :param max_concurrent_uploads: maximum number of images uploaded at the same time
+        :param image_preprocessor: ImagePreprocessor, resize and recompress local images before upload
+        :param coalesce_window: seconds, messages sent to the same target within the window are merged into one
+               message (up to max_message_length), None to disable. Can be overridden per send_message call
+        :param max_message_length: maximum length of a message, measured by chain_length
+        :param retry_sends: bool, whether messages are retried if the console is unreachable.
+               A retried message may be delivered twice if the console received it but the response was lost
+        :param websocket_commands: bool, whether API calls are sent as commands over the websocket opened by
+               create_websocket (requires mirai-api-http v2), http is used until the websocket is connected
+        :param compression: bool, whether to negotiate websocket and http response compression,
+               see HttpClient.compression_stats
+        :param intern_entities: bool, whether parsed Group, Member and Friend are shared instances (see EntityMap),
+               so that events from the same sender and group do not allocate new models and can be compared by identity.
+               Fields of a shared instance are updated by later events
+        :param split_long_messages: bool, whether a message longer than max_message_length is split and sent as
+               several messages (send_message then returns a list of BotMessage). Can be overridden per call
+        :param coalesce_separator: str, text inserted between merged messages (such as '\\n'), nothing by default
+        """
         self.qq = qq
+        self.trusted = trusted
         self.verify_key = verify_key
         self.base_url = f'{scheme}://{host}:{port}'
         self.loop = loop
-        self.session = HttpClient(self.base_url, loop=self.loop)
+        self.session = HttpClient(self.base_url, loop=self.loop, websocket_commands=websocket_commands,
+                                  compression=compression)
         self.session_key = ''
         self.logger = create_logger('Bot')
+        self.max_concurrent_uploads = max_concurrent_uploads
+        self.image_preprocessor = image_preprocessor
+        self.coalesce_window = coalesce_window
+        self.coalesce_separator = coalesce_separator
+        self.max_message_length = max_message_length
+        self.retry_sends = retry_sends
+        self.split_long_messages = split_long_messages
+        self.entities: Optional[EntityMap] = EntityMap() if intern_entities else None
+        self._outbound_batches: Dict[tuple, _OutboundBatch] = {}
+        self._upload_semaphore: Optional[asyncio.Semaphore] = None
+        self._pending_uploads: Dict[Tuple, asyncio.Future] = {}
+        self._image_fetcher: Optional[ImageFetcher] = None
 
     async def handshake(self):
         """
@@ -102,6 +234,15 @@ class Bot:
             except:
                 raise ValueError(f'target does not contain id attribute')
 
+    def _is_trusted(self, trusted: Optional[bool]) -> bool:
+        """
+        Internal use only, resolve per call trusted argument
+
+        :param trusted: None to use Bot.trusted
+        :return: bool
+        """
+        return self.trusted if trusted is None else trusted
+
     @retry_once
     async def send_message(self,
                            target: Union[Friend, Member, Group, int],
@@ -110,11 +251,14 @@ class Bot:
                                MessageChain,
                                BaseMessageComponent,
                                List[BaseMessageComponent],
+                               RenderedMessage,
                                str
                            ] = '',
                            temp_group: Optional[int] = None,
-                           quote_source: Union[int, Source] = None
-                           ) -> BotMessage:
+                           quote_source: Union[int, Source] = None,
+                           coalesce: Optional[bool] = None,
+                           split: Optional[bool] = None
+                           ) -> Union[BotMessage, List[BotMessage]]:
         """
         Send Group/Friend message, only keyword arguments are allowed
         Image ID is available in returned message if uploaded via file path
@@ -122,13 +266,46 @@ class Bot:
         :param target: Group, Member, Friend, int
         :param message_type: ChatType, specify the type of target
         :param temp_group: If message_type is Member and target is int, then temp group must be specified
-        :param message: MessageChain, BaseMessageComponent, List of BaseMessageComponent or str, the content to send
+        :param message: MessageChain, BaseMessageComponent, List of BaseMessageComponent, RenderedMessage or str,
+               the content to send
         :param quote_source: int (the 64-bit int) or Source, the message to quote
                The purpose of this argument is to save image ids for future use.
+        :param coalesce: bool, whether to merge with other messages to the same target within coalesce_window,
+               defaults to enabled if Bot.coalesce_window is set. All merged calls return the same BotMessage,
+               or raise CoalescedMessageException if it is not sent after one handshake for the whole batch
+        :param split: bool, whether to split the message if it is longer than max_message_length,
+               defaults to Bot.split_long_messages. Parts are sent in order, only the first part quotes quote_source.
+               If a part other than the first fails, PartialMessageException is raised with the sent parts
+
+        :return: BotMessage (contains message id), or list of BotMessage if the message is split
+        """
+
+        portal, data = await self._build_message(target, message_type, message, temp_group, quote_source)
 
-        :return: BotMessage (contains message id)
+        if (split or (split is None and self.split_long_messages)) and \
+                self.chain_length(data['messageChain']) > self.max_message_length:
+            return await self._send_parts(portal, data)
+
+        if coalesce or (coalesce is None and self.coalesce_window is not None):
+            return await self._coalesce_message(portal, data)
+
+        result = await self.session.post(portal, data=data, idempotent=self.retry_sends)
+        bot_message = BotMessage.parse_obj(result)
+        return bot_message
+
+    async def _build_message(self,
+                             target: Union[Friend, Member, Group, int],
+                             message_type: MessageType,
+                             message: Union[MessageChain, BaseMessageComponent, List[BaseMessageComponent],
+                                            RenderedMessage, str],
+                             temp_group: Optional[int] = None,
+                             quote_source: Union[int, Source] = None) -> Tuple[str, Dict]:
         """
+        Internal use only
+        Upload images and serialize the message, see send_message for arguments
 
+        :return: (sub url, post data)
+        """
         data = {
             'sessionKey':   self.session_key,
         }
@@ -153,9 +330,11 @@ class Bot:
         else:
             raise ValueError('One of friend, member and group must not be empty')
 
-        message_chain = await self._handle_message_chain(message, message_type)
-
-        data['messageChain'] = json.loads(message_chain.json())
+        if isinstance(message, RenderedMessage):  # already serialized by MessageTemplate
+            data['messageChain'] = message.message_chain
+        else:
+            message_chain = await self._handle_message_chain(message, message_type)
+            data['messageChain'] = json.loads(message_chain.json())
 
         if quote_source:
             if isinstance(quote_source, int):
@@ -163,9 +342,174 @@ class Bot:
             elif isinstance(quote_source, Source):
                 data['quote'] = quote_source.id
 
-        result = await self.session.post(portal, data=data)
-        bot_message = BotMessage.parse_obj(result)
-        return bot_message
+        return portal, data
+
+    @staticmethod
+    def chain_length(message_chain: List[Dict]) -> int:
+        """
+        Measure the length of a serialized message chain, as compared with max_message_length
+
+        :param message_chain: serialized message chain
+        :return: int
+        """
+        return len(json.dumps(message_chain, ensure_ascii=False))
+
+    @classmethod
+    def split_chain(cls, message_chain: List[Dict], max_length: int) -> Iterator[List[Dict]]:
+        """
+        Split a serialized message chain into chains not longer than max_length, measured by chain_length
+        Components are kept whole except Plain, whose text is split at a line break or space if possible.
+        A component other than Plain that is longer than max_length is yielded alone
+
+        :param message_chain: serialized message chain
+        :param max_length: int
+        :return: iterator of serialized message chains, computed as they are consumed
+        """
+        part: List[Dict] = []
+        length = 2  # brackets of the list
+        for component in message_chain:
+            size = len(json.dumps(component, ensure_ascii=False)) + (2 if part else 0)  # ', ' between components
+            if length + size <= max_length:
+                part.append(component)
+                length += size
+                continue
+            if component.get('type') != 'Plain':
+                if part:
+                    yield part
+                    size -= 2
+                part, length = [component], 2 + size
+                continue
+            text = component['text']
+            while text:
+                room = max_length - length - (2 if part else 0)
+                cut = cls._fit_text(text, room)
+                if cut == len(text):
+                    part.append({**component, 'text': text})
+                    length += len(json.dumps(part[-1], ensure_ascii=False)) + (2 if len(part) > 1 else 0)
+                    break
+                # start a new part instead if the text fits in it, or little room is left
+                if part and (cut < max_length // 4 or
+                             len(json.dumps({**component, 'text': text}, ensure_ascii=False)) + 2 <= max_length):
+                    yield part
+                    part, length = [], 2
+                    continue
+                boundary = max(text.rfind('\n', 0, cut), text.rfind(' ', 0, cut)) + 1
+                if boundary > cut // 2:
+                    cut = boundary
+                part.append({**component, 'text': text[:max(cut, 1)]})
+                yield part
+                part, length = [], 2
+                text = text[max(cut, 1):]
+        if part:
+            yield part
+
+    @staticmethod
+    def _fit_text(text: str, room: int) -> int:
+        """
+        Internal use only
+        Find the number of characters of text that fit in room as a serialized Plain component
+
+        :return: int
+        """
+        room -= len(json.dumps({'type': 'Plain', 'text': ''}, ensure_ascii=False))
+        low, high = 0, min(len(text), max(room, 0))  # every character takes at least one
+        while low < high:
+            middle = (low + high + 1) // 2
+            if len(json.dumps(text[:middle], ensure_ascii=False)) - 2 <= room:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    async def _send_parts(self, portal: str, data: Dict) -> List[BotMessage]:
+        """
+        Internal use only
+        Split the message and send the parts in order, the next part is prepared while the previous one is sent
+
+        :param portal: the sub url
+        :param data: post params
+        :return: list of BotMessage
+        """
+        base = {key: value for key, value in data.items() if key not in ('messageChain', 'quote')}
+        parts = self.split_chain(data['messageChain'], self.max_message_length)
+        request = {**data, 'messageChain': next(parts)}
+        results: List[BotMessage] = []
+        total = 1
+        while request is not None:
+            sending = asyncio.ensure_future(self.session.post(portal, data=request, idempotent=self.retry_sends))
+            await asyncio.sleep(0)  # let the request start before preparing the next part
+            part = next(parts, None)
+            request = None if part is None else {**base, 'messageChain': part}
+            total += part is not None
+            try:
+                results.append(BotMessage.parse_obj(await sending))
+            except Exception as e:
+                if not results:
+                    raise
+                total += sum(1 for _ in parts)
+                raise PartialMessageException(results, total) from e
+        self.logger.debug(f'Long message sent in {len(results)} parts')
+        return results
+
+    async def _coalesce_message(self, portal: str, data: Dict) -> BotMessage:
+        """
+        Internal use only
+        Add the message to the batch of the same target, the batch is sent when coalesce_window passes,
+        or earlier if the next message has a different quote or exceeds max_message_length
+
+        :param portal: the sub url
+        :param data: post params
+        :return: BotMessage of the merged message
+        """
+        key = (portal, data.get('target'), data.get('group'), data.get('qq'))
+        length = self.chain_length(data['messageChain'])
+        batch = self._outbound_batches.get(key)
+        if batch is not None and (batch.quote != data.get('quote') or
+                                  batch.added_length(length) > self.max_message_length):
+            self._send_batch(key, batch)
+            batch = None
+        if batch is None:
+            batch = _OutboundBatch(portal, data, self.coalesce_separator)
+            self._outbound_batches[key] = batch
+            asyncio.get_event_loop().call_later(self.coalesce_window or 0, self._send_batch, key, batch)
+        future = batch.add(data['messageChain'], length)
+        return await asyncio.shield(future)
+
+    def _send_batch(self, key: tuple, batch: '_OutboundBatch') -> None:
+        """
+        Internal use only, close the batch and send it in background
+        """
+        if self._outbound_batches.get(key) is batch:
+            del self._outbound_batches[key]
+            asyncio.ensure_future(self._post_batch(batch))
+
+    async def _post_batch(self, batch: '_OutboundBatch') -> None:
+        """
+        Internal use only
+        Send the merged message, fall back to sending each message separately if it is too long
+        The batch handshakes at most once, a message that still fails is raised to the merged calls as
+        CoalescedMessageException, which is not retried by each of them
+        """
+        handshake = _BatchHandshake(self)
+        try:
+            bot_message = await handshake.post(batch.portal, batch.merged_data())
+            for _, future in batch.parts:
+                future.set_result(bot_message)
+            return
+        except MessageTooLongException as e:
+            if len(batch.parts) == 1:
+                batch.parts[0][1].set_exception(e)
+                return
+            self.logger.warning(f'Merged message is too long, sending {len(batch.parts)} messages separately')
+        except Exception as e:
+            for _, future in batch.parts:
+                future.set_exception(e)
+            return
+        for message_chain, future in batch.parts:
+            try:
+                future.set_result(await handshake.post(batch.portal, {**batch.data, 'messageChain': message_chain}))
+            except Exception as e:
+                future.set_exception(e)
 
     @retry_once
     async def recall(self, source: Union[Source, int]) -> None:
@@ -188,11 +532,20 @@ class Bot:
         await self.session.post('/recall', data=data)
 
     @property
-    @retry_once
     async def groups(self) -> List[Group]:
         """
         Get list of joined groups
 
+        :return: List of Group
+        """
+        return await self.get_groups()
+
+    @retry_once
+    async def get_groups(self, trusted: Optional[bool] = None) -> List[Group]:
+        """
+        Get list of joined groups
+
+        :param trusted: bool, skip validation for this call, defaults to Bot.trusted
         :return: List of Group
         """
         params = {
@@ -201,14 +554,26 @@ class Bot:
         result = await self.session.get('/groupList', params=params)
         if result['code'] != 0:
             raise MiraiException('Failed to retrieve group list')
-        return [Group.parse_obj(group_info) for group_info in result['data']]
+        parse = Group.parse_trusted if self._is_trusted(trusted) else Group.parse_obj
+        if self.entities is not None:
+            return [self.entities.intern(parse(group_info)) for group_info in result['data']]
+        return [parse(group_info) for group_info in result['data']]
 
     @property
-    @retry_once
     async def friends(self) -> List[Friend]:
         """
         Get list of friends
 
+        :return: List of Friend
+        """
+        return await self.get_friends()
+
+    @retry_once
+    async def get_friends(self, trusted: Optional[bool] = None) -> List[Friend]:
+        """
+        Get list of friends
+
+        :param trusted: bool, skip validation for this call, defaults to Bot.trusted
         :return: List of Friend
         """
         params = {
@@ -217,14 +582,18 @@ class Bot:
         result = await self.session.get('/friendList', params=params)
         if result['code'] != 0:
             raise MiraiException('Failed to retrieve friend list')
-        return [Friend.parse_obj(friend_info) for friend_info in result['data']]
+        parse = Friend.parse_trusted if self._is_trusted(trusted) else Friend.parse_obj
+        if self.entities is not None:
+            return [self.entities.intern(parse(friend_info)) for friend_info in result['data']]
+        return [parse(friend_info) for friend_info in result['data']]
 
     @retry_once
-    async def get_members(self, target: Union[Group, int]) -> List[Member]:
+    async def get_members(self, target: Union[Group, int], trusted: Optional[bool] = None) -> List[Member]:
         """
         Get list of members of a group
 
         :param target: int or Group, the target group
+        :param trusted: bool, skip validation for this call, defaults to Bot.trusted
         :return: List of Member
         """
         if isinstance(target, int):
@@ -238,7 +607,87 @@ class Bot:
         result = await self.session.get('/memberList', params=params)
         if result['code'] != 0:
             raise MiraiException('Failed to retrieve member list')
-        return [Member.parse_obj(member_info) for member_info in result['data']]
+        parse = Member.parse_trusted if self._is_trusted(trusted) else Member.parse_obj
+        if self.entities is not None:
+            return [self.entities.intern(parse(member_info)) for member_info in result['data']]
+        return [parse(member_info) for member_info in result['data']]
+
+    async def iter_members(self, target: Union[Group, int], trusted: Optional[bool] = None,
+                           compact: bool = False) -> AsyncIterator[Union[Member, MemberSummary]]:
+        """
+        Get members of a group one by one, parsed while the response is received
+        All members share one Group instance. Recommended for large groups
+        Like get_members, the request is retried once after handshake if it fails before any member is yielded
+        Stop early with contextlib.aclosing (Python 3.10+) or aclose() so that the response is closed immediately
+
+        Example:
+            async for member in bot.iter_members(group, compact=True):
+                ...
+
+        :param target: int or Group, the target group
+        :param trusted: bool, skip validation for this call, defaults to Bot.trusted
+        :param compact: bool, yield MemberSummary (id, memberName, permission) instead of Member
+        :return: async iterator of Member or MemberSummary
+        """
+        trusted = self._is_trusted(trusted)
+        for attempt in range(2):
+            yielded = False
+            members = self._iter_members(target, trusted, compact)
+            try:
+                async for member in members:
+                    yielded = True
+                    yield member
+                return
+            except CircuitOpenException as e:  # handshake would be rejected as well
+                self.logger.warning(str(e))
+                return
+            except (NetworkException, SessionException, AuthenticationException):
+                if yielded:  # retrying would yield the same members again
+                    raise
+                if attempt:
+                    self.logger.exception('Unable to handshake')
+                    return
+                self.logger.exception('Trying handshake due to the following exception')
+            finally:
+                await members.aclose()
+            try:
+                await self.handshake()
+            except (NetworkException, SessionException, AuthenticationException):
+                self.logger.exception('Unable to handshake')
+                return
+
+    async def _iter_members(self, target: Union[Group, int], trusted: bool,
+                            compact: bool) -> AsyncIterator[Union[Member, MemberSummary]]:
+        """
+        Internal use only, see iter_members
+        """
+        params = {
+            'sessionKey': self.session_key,
+            'target':     target if isinstance(target, int) else target.id
+        }
+        group = None
+        group_info = None
+        entities = self.entities
+        async for member_info in self.session.iter_items('/memberList', params=params):
+            if compact:
+                yield MemberSummary(member_info['id'], member_info['memberName'],
+                                    Permission(member_info['permission']))
+                continue
+            if entities is not None and trusted:
+                yield entities.member(member_info)
+                continue
+            if group is None or member_info['group'] != group_info:
+                group_info = member_info['group']
+                group = Group.parse_trusted(group_info) if trusted else Group.parse_obj(group_info)
+                if entities is not None:
+                    group = entities.intern(group)
+            if trusted:
+                yield Member.construct(id=member_info['id'], memberName=member_info['memberName'],
+                                       permission=Permission(member_info['permission']), group=group)
+            elif entities is not None:
+                yield entities.intern(Member.parse_with_group(member_info, group))
+            else:
+                yield Member.parse_with_group(member_info, group)
 
     @retry_once
     async def upload_image(self, message_type: MessageType, image_path: Union[Path, str]) -> Optional[Image]:
@@ -251,12 +700,22 @@ class Bot:
         :param image_path: absolute path of the image
         :return: Image object
         """
+        return await self._upload_image(message_type, image_path)
+
+    async def _upload_image(self, message_type: MessageType, image_path: Union[Path, str]) -> Image:
+        """
+        Internal use only
+        Upload a image without retry, callers retry once for the whole message, see upload_image for arguments
+        """
         if isinstance(image_path, str):
             image_path = Path(image_path)
 
         if not image_path.exists():
             raise FileNotFoundError('Image not found.')
 
+        if self.image_preprocessor is not None:
+            image_path = await self.image_preprocessor.process(image_path)
+
         data = {
             'sessionKey': self.session_key,
             'type': message_type.chat_type
@@ -512,29 +971,124 @@ class Bot:
         else:
             raise TypeError(f'Unsupported event: {str(request)}')
 
+    @property
+    def image_fetcher(self) -> ImageFetcher:
+        """
+        The ImageFetcher used by fetch_image, an in-memory cache is created on first use
+        Assign an ImageFetcher to enable disk cache or prefetching, e.g.
+            bot.image_fetcher = ImageFetcher(bot.session, cache_dir='image_cache', prefetch=True)
+        """
+        if self._image_fetcher is None:
+            self._image_fetcher = ImageFetcher(self.session)
+        return self._image_fetcher
+
+    @image_fetcher.setter
+    def image_fetcher(self, image_fetcher: ImageFetcher):
+        self._image_fetcher = image_fetcher
+
+    async def fetch_image(self, image: Union[Image, FlashImage, str]) -> bytes:
+        """
+        Download a received image, cached by imageId, concurrent calls share one download
+
+        :param image: Image, FlashImage or url
+        :return: bytes
+        """
+        return await self.image_fetcher.fetch(image)
+
+    def prefetch_images(self, event: BaseEvent) -> None:
+        """
+        Internal use only
+        Start downloading images in the message, if prefetch is enabled in image_fetcher
+
+        :param event: the event
+        """
+        if self._image_fetcher is not None and self._image_fetcher.prefetch:
+            self._image_fetcher.prefetch_event(event)
+
+    def start_upload(self, message_component: Union[Image, FlashImage], message_type: MessageType) -> asyncio.Future:
+        """
+        Start uploading the image in background (only if the image is uploaded by path),
+        so that the upload runs while the rest of the message is being built.
+        The message sent later with this component waits for the upload instead of starting a new one
+
+        :param message_component: Image or FlashImage
+        :param message_type: MessageType, the target chat type
+        :return: Future of the component, imageId is set once done
+        """
+        return asyncio.ensure_future(self._handle_message_component(message_component, message_type))
+
+    @staticmethod
+    def _upload_key(message_component: Union[Image, FlashImage], message_type: MessageType) -> Tuple:
+        """
+        Internal use only, identify an upload by its source, since image ids are only valid for one chat type
+        """
+        source = message_component.path or message_component.url or message_component.imageId
+        return message_type.chat_type, str(source)
+
     async def _handle_message_component(self, message_component: BaseMessageComponent, message_type: MessageType) -> BaseMessageComponent:
         """
         Internal use only
         Upload Image and get uuid for the image (only if the image is uploaded by path)
+        Components with the same source share one upload, whether started by start_upload or another message
 
         :param message_component: BaseMessageComponent
         :param message_type: ImageType
         :return: BaseMessageComponent
         """
-        if not isinstance(message_component, (Image, FlashImage)):
+        if not isinstance(message_component, (Image, FlashImage)) or \
+                not self._needs_upload(message_component, message_type):
             return message_component
 
+        key = self._upload_key(message_component, message_type)
+        pending = self._pending_uploads.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._upload_message_component(message_component, message_type))
+            self._pending_uploads[key] = pending
+            pending.add_done_callback(lambda future: self._upload_done(key, future))
+        uploaded = await asyncio.shield(pending)
+        if uploaded is not message_component:
+            message_component.imageId = uploaded.imageId
+        return message_component
+
+    def _upload_done(self, key: Tuple, future: asyncio.Future) -> None:
+        """
+        Internal use only
+        """
+        self._pending_uploads.pop(key, None)
+        if not future.cancelled():
+            future.exception()  # raised to the waiting messages, do not log it again if none is left
+
+    @staticmethod
+    def _needs_upload(message_component: Union[Image, FlashImage], message_type: MessageType) -> bool:
+        """
+        Internal use only
+        Drop the image id if it is for another chat type, and check whether the image has to be uploaded by path
+        """
         if message_type == MessageType.GROUP:
             if message_component.imageId and message_component.imageId.startswith('/'):
                 message_component.imageId = None
         else:
             if message_component.imageId and message_component.imageId.startswith('{'):
                 message_component.imageId = None
+        return not (message_component.imageId or message_component.url)
 
-        if message_component.imageId or message_component.url:
+    async def _upload_message_component(self, message_component: Union[Image, FlashImage],
+                                        message_type: MessageType) -> BaseMessageComponent:
+        """
+        Internal use only
+        Upload Image and get uuid for the image, at most max_concurrent_uploads at the same time
+
+        :param message_component: Image or FlashImage
+        :param message_type: ImageType
+        :return: BaseMessageComponent
+        """
+        if not self._needs_upload(message_component, message_type):
             return message_component
 
-        image = await self.upload_image(message_type, message_component.path)
+        if self._upload_semaphore is None:
+            self._upload_semaphore = asyncio.Semaphore(self.max_concurrent_uploads)
+        async with self._upload_semaphore:
+            image = await self._upload_image(message_type, message_component.path)
         message_component.imageId = image.imageId
 
         return message_component
@@ -549,6 +1103,7 @@ class Bot:
         """
         Internal use only
         Convert MessageChain to json
+        Images are uploaded concurrently, component order is kept
 
         :param message: MessageChain
         :param message_type: the target chat type (to determine image upload args)
@@ -561,10 +1116,36 @@ class Bot:
         elif isinstance(message, (BaseMessageComponent, tuple, list)):
             if isinstance(message, BaseMessageComponent):
                 message = [message]
-            return MessageChain.parse_obj([await self._handle_message_component(m, message_type=message_type) for m in message])
+            results = await asyncio.gather(*[self._handle_message_component(m, message_type=message_type)
+                                             for m in message], return_exceptions=True)
+            failures = {index: result for index, result in enumerate(results) if isinstance(result, BaseException)}
+            if failures:
+                raise ImageUploadException(failures)
+            return MessageChain.parse_obj(results)
         else:
             raise ValueError('Invalid message')
 
+    @retry_once
+    async def compile_template(self, message: Union[
+                                                   MessageChain,
+                                                   List[Union[BaseMessageComponent, Placeholder, str]]
+                                                   ],
+                               message_type: MessageType) -> Optional[MessageTemplate]:
+        """
+        Upload images in the template (only if the image is uploaded by path), and compile it
+        The compiled template is only valid for the given message_type, since image ids are not exchangeable
+
+        :param message: MessageChain, or list of BaseMessageComponent, Placeholder and str
+        :param message_type: the target chat type (to determine image upload args)
+        :return: MessageTemplate
+        """
+        components = []
+        for component in message:
+            if isinstance(component, BaseMessageComponent):
+                component = await self._handle_message_component(component, message_type=message_type)
+            components.append(component)
+        return MessageTemplate(components)
+
     @retry_once
     async def get_config(self) -> dict:
         """
@@ -596,17 +1177,23 @@ class Bot:
 
         await self.session.post('/config', data=data)
 
-    def _parse_event(self, result) -> Union[BaseEvent, None]:
+    def _parse_event(self, result, trusted: Optional[bool] = None) -> Union[BaseEvent, None]:
         """
         Internal use only
         Parse event or message from json to BaseEvent
 
         :param result: the json
+        :param trusted: bool, skip validation for this call, defaults to Bot.trusted
         :return: BaseEvent or None
         """
 
         try:
-            result = WebSocketEvent.parse_obj(result).data
+            if self._is_trusted(trusted):
+                result = parse_trusted_event(result['data'], self.entities)
+            else:
+                result = WebSocketEvent.parse_obj(result).data
+                if self.entities is not None:
+                    self.entities.intern_fields(result)
             if isinstance(result, AuthEvent):
                 return None
             if isinstance(result, Message):  # construct message chain
@@ -647,18 +1234,26 @@ class Bot:
         return _handler
 
     @retry_once
-    async def create_websocket(self, handler, ws_close_handler=None, listen: str = 'all') -> None:
+    async def create_websocket(self, handler, ws_close_handler=None, listen: str = 'all',
+                               reconnect: bool = False, handshake: bool = True) -> None:
         """
         Register callback for websocket. Once an BaseEvent or Message is received, the handler will be invoked
 
         :param handler: callable
         :param ws_close_handler: callable, websocket shutdown hook
         :param listen: 'all', 'event' or 'message'
+        :param reconnect: bool, whether to handshake and reconnect with backoff when disconnected,
+               until HttpClient.close_websockets is called. See HttpClient.websocket_stats for connection metrics
+        :param handshake: bool, whether to handshake before reconnecting. Set to False if several websockets are open,
+               so that reconnecting one does not replace the session used by the others
+               (the websocket authenticates itself, an expired session is renewed by the next failed request)
         """
         if listen not in ('all', 'event', 'message'):
             raise ValueError("listen must be one of 'all', 'event' or 'message'")
         if ws_close_handler is None:
-            async def ws_close_handler(event):
+            async def ws_close_handler():
                 pass
         await self.session.websocket(f'/{listen}?verifyKey={self.verify_key}&qq={self.qq}',
-                                     self._websocket_handler(handler), ws_close_handler)
\ No newline at end of file
+                                     self._websocket_handler(handler), ws_close_handler,
+                                     reconnect=reconnect,
+                                     on_reconnect=self.handshake if reconnect and handshake else None)
\ No newline at end of file
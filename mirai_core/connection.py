@@ -0,0 +1,265 @@
+from typing import Dict, Optional, Callable, Awaitable, Any
+import asyncio
+import json
+import time
+import aiohttp
+from aiohttp import client_exceptions
+from .log import create_logger
+from .metrics import Histogram
+from .resilience import backoff
+from .exceptions import NetworkException
+
+RTT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+GAP_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+class WebsocketConnection:
+    """
+    Internal use only
+    Keep one websocket connected
+
+    Heartbeat pings are sent by this class (instead of aiohttp autoping) to measure round trip time.
+    If a pong is not received within pong_timeout, the socket is considered half open and is reconnected.
+    Reconnection uses jittered exponential backoff, and the duration of each disconnect is recorded.
+    Frames are handled in order by a separate task, so that the reader keeps resolving command responses
+    while a handler waits for one.
+    """
+
+    def __init__(self, client, url: str, handler: Callable[[Any], Awaitable[None]], reconnect: bool = False,
+                 on_reconnect: Optional[Callable[[], Awaitable[None]]] = None,
+                 heartbeat: float = 5, pong_timeout: Optional[float] = None):
+        """
+        Initialize WebsocketConnection
+
+        :param client: HttpClient
+        :param url: the sub url
+        :param handler: callable, called with each decoded text frame
+        :param reconnect: bool, whether to reconnect after disconnect, otherwise run returns after the first disconnect
+        :param on_reconnect: callable, awaited before each reconnection (such as Bot.handshake),
+               an exception counts as a failed attempt
+        :param heartbeat: seconds between pings
+        :param pong_timeout: seconds to wait for a pong before reconnecting, defaults to heartbeat
+        """
+        self.client = client
+        self.url = url
+        self.name = url.split('?', 1)[0]  # query contains verify key
+        self.handler = handler
+        self.reconnect = reconnect
+        self.on_reconnect = on_reconnect
+        self.heartbeat = heartbeat
+        self.pong_timeout = heartbeat if pong_timeout is None else pong_timeout
+        self.logger = create_logger('Websocket')
+        self.ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self.closed = False
+        self.connects = 0
+        self.disconnects = 0
+        self.half_open = 0  # disconnects due to missing pong
+        self.frames = 0
+        self.chars_received = 0  # characters of text frames, not encoded again to count bytes
+        self.compress = 0  # negotiated permessage-deflate window bits, 0 if not compressed
+        self.fps = 0.0  # text frames per second, measured between heartbeats
+        self.last_rtt: Optional[float] = None
+        self.rtt = Histogram(RTT_BUCKETS)
+        self.gaps = Histogram(GAP_BUCKETS)  # seconds disconnected before each reconnection
+        self.disconnected_since: Optional[float] = time.monotonic()
+        self._ping_sent: Optional[float] = None
+        self._frames: 'asyncio.Queue[Any]' = asyncio.Queue()
+
+    @property
+    def connected(self) -> bool:
+        return self.ws is not None and not self.ws.closed
+
+    @property
+    def gap(self) -> float:
+        """
+        Seconds since disconnected, 0 if connected
+        """
+        return 0.0 if self.disconnected_since is None else time.monotonic() - self.disconnected_since
+
+    async def run(self) -> None:
+        """
+        Connect and receive until closed, reconnecting after each disconnect if reconnect is set
+        Received frames are handled before returning
+        """
+        consumer = asyncio.ensure_future(self._consume())
+        try:
+            await self._run()
+        finally:
+            self._frames.put_nowait(None)
+            await consumer
+
+    async def _consume(self) -> None:
+        """
+        Internal use only, call the handler for each received frame until None is queued
+        """
+        while True:
+            frame = await self._frames.get()
+            if frame is None:
+                return
+            text, result = frame
+            try:
+                if text is not None:
+                    result = json.loads(text)
+                await self.handler(result)
+            except Exception:
+                self.logger.exception(f'Unhandled exception in websocket handler of {self.name}')
+
+    async def _run(self) -> None:
+        """
+        Internal use only
+        """
+        attempt = 0
+        while not self.closed:
+            if self.connects and self.on_reconnect is not None:
+                try:
+                    await self.on_reconnect()
+                except Exception as e:
+                    attempt = await self._wait(attempt, e)
+                    continue
+            try:
+                ws = await self.client.connect_websocket(self.url)
+            except NetworkException as e:
+                if not self.reconnect:
+                    raise
+                attempt = await self._wait(attempt, e)
+                continue
+            if self.closed:  # closed while connecting
+                await ws.close()
+                break
+            connected_at = time.monotonic()
+            self._connected(ws)
+            try:
+                await self._receive(ws)
+            finally:
+                self._disconnected(ws)
+            if not self.reconnect:
+                break
+            if time.monotonic() - connected_at >= self.heartbeat:
+                attempt = 0
+            if not self.closed:
+                attempt = await self._wait(attempt, None)
+
+    async def _wait(self, attempt: int, error: Optional[Exception]) -> int:
+        """
+        Internal use only, sleep before the next attempt
+
+        :return: next attempt number
+        """
+        delay = backoff(attempt, base=0.5, cap=30)
+        if error is not None:
+            self.logger.warning(f'Unable to connect {self.name} ({error}), retrying in {delay:.1f} seconds')
+        else:
+            self.logger.warning(f'Websocket {self.name} disconnected, reconnecting in {delay:.1f} seconds')
+        await asyncio.sleep(delay)
+        return attempt + 1
+
+    def _connected(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        """
+        Internal use only
+        """
+        self.ws = ws
+        self.compress = ws.compress
+        self.connects += 1
+        if self.connects > 1:
+            self.gaps.observe(self.gap)
+        self.disconnected_since = None
+        self._ping_sent = None
+        self.client.websockets.add(ws)
+        self.logger.debug(f'Websocket {self.name} established')
+
+    def _disconnected(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        """
+        Internal use only
+        """
+        self.client.websockets.discard(ws)
+        self.client._fail_commands(ws)
+        self.ws = None
+        self.disconnects += 1
+        self.disconnected_since = time.monotonic()
+
+    async def _receive(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        """
+        Internal use only, receive frames, send heartbeats and answer pings until the socket is closed or half open
+        """
+        loop = asyncio.get_event_loop()
+        next_ping = loop.time() + self.heartbeat
+        last_tick, last_frames = loop.time(), self.frames
+        while not self.closed:
+            now = loop.time()
+            if self._ping_sent is not None and now - self._ping_sent >= self.pong_timeout:
+                self.half_open += 1
+                self.logger.warning(f'Websocket {self.name} did not answer ping in {self.pong_timeout} seconds')
+                try:
+                    await asyncio.wait_for(ws.close(), 1)
+                except (asyncio.TimeoutError, client_exceptions.ClientError):
+                    pass
+                return
+            if now >= next_ping and self._ping_sent is None:
+                self.fps = (self.frames - last_frames) / (now - last_tick)
+                last_tick, last_frames = now, self.frames
+                self._ping_sent = now
+                next_ping = now + self.heartbeat
+                try:
+                    await ws.ping()
+                except (ConnectionResetError, client_exceptions.ClientError):
+                    return
+            deadline = next_ping if self._ping_sent is None else self._ping_sent + self.pong_timeout
+            try:
+                msg = await ws.receive(timeout=max(deadline - now, 0.001))
+            except asyncio.TimeoutError:
+                continue
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                self.frames += 1
+                self.chars_received += len(msg.data)
+                self.logger.debug(f'Websocket received {msg}')
+                if not self.client._pending_commands:  # not a command response, decoded by the consumer
+                    self._frames.put_nowait((msg.data, None))
+                    continue
+                result = msg.json()
+                if not self.client._resolve_command(result):
+                    self._frames.put_nowait((None, result))
+            elif msg.type == aiohttp.WSMsgType.PING:
+                await ws.pong(msg.data)
+            elif msg.type == aiohttp.WSMsgType.PONG:
+                if self._ping_sent is not None:
+                    self.last_rtt = loop.time() - self._ping_sent
+                    self.rtt.observe(self.last_rtt)
+                    self._ping_sent = None
+            elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED,
+                              aiohttp.WSMsgType.ERROR):
+                self.logger.debug(f'Websocket {self.name} closed')
+                return
+            else:
+                self.logger.warning(f'Received unexpected type: {msg.type}')
+
+    async def close(self) -> None:
+        """
+        Close the websocket and stop reconnecting
+        """
+        self.closed = True
+        if self.ws is not None:
+            await self.ws.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get connection metrics
+
+        :return: dict of connected, connects, disconnects, half_open, gap (current seconds disconnected),
+                 gaps (Histogram.snapshot() of past disconnects), frames, chars_received, compress, fps,
+                 backlog (frames waiting for the handler), last_rtt and rtt (Histogram.snapshot())
+        """
+        return {
+            'connected': self.connected,
+            'connects': self.connects,
+            'disconnects': self.disconnects,
+            'half_open': self.half_open,
+            'gap': self.gap,
+            'gaps': self.gaps.snapshot(),
+            'frames': self.frames,
+            'chars_received': self.chars_received,
+            'compress': self.compress,
+            'fps': self.fps,
+            'backlog': self._frames.qsize(),
+            'last_rtt': self.last_rtt,
+            'rtt': self.rtt.snapshot(),
+        }
@@ -33,6 +33,13 @@ class PrivilegeException(MiraiException):
     pass
 
 
+class MessageTooLongException(PrivilegeException):
+    """
+    Message exceeds the length limit of mirai
+    """
+    pass
+
+
 class UnknownTargetException(MiraiException):
     """
     Target not found (sending to non-existing group, friend, etc.)
@@ -53,3 +60,48 @@ class ServerException(MiraiException):
     This is more likely to be mirai side issue, but sometimes incorrect parameters can cause this problem too
     """
     pass
+
+
+class ImageUploadException(MiraiException):
+    """
+    One or more images in a message chain failed to upload
+    failures maps the index of each failed component to its exception
+    """
+    def __init__(self, failures: dict):
+        self.failures = failures
+        super().__init__('Failed to upload image at index ' +
+                         ', '.join(f'{index} ({exception!r})' for index, exception in failures.items()))
+
+    @property
+    def retryable(self) -> bool:
+        """
+        Whether all uploads failed due to the connection or session, so that they may succeed after handshake
+        """
+        return all(isinstance(exception, (NetworkException, SessionException, AuthenticationException))
+                   for exception in self.failures.values())
+
+
+class CircuitOpenException(NetworkException):
+    """
+    Request is rejected without being sent, because the Mirai console has been unreachable recently
+    """
+    pass
+
+
+class PartialMessageException(MiraiException):
+    """
+    A long message was split and only some of the parts were sent, see Bot(split_long_messages=True)
+    sent contains BotMessage of the delivered parts, the cause is the exception of the failed part
+    """
+    def __init__(self, sent: list, total: int):
+        self.sent = sent
+        self.total = total
+        super().__init__(f'Sent {len(sent)} of {total} parts of the message')
+
+
+class CoalescedMessageException(MiraiException):
+    """
+    A merged message (see Bot.coalesce_window) could not be sent after one handshake and retry for the whole batch
+    Raised to each merged call instead of letting each of them handshake and retry again
+    """
+    pass
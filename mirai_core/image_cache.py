@@ -0,0 +1,255 @@
+from typing import Dict, Optional, Union, List, Tuple
+from collections import OrderedDict
+from pathlib import Path
+import asyncio
+import hashlib
+import os
+from .log import create_logger
+from .network import HttpClient
+from .models.Message import Image, FlashImage
+from .models.Event import BaseEvent, Message
+
+
+class ImageFetcher:
+    """
+    Download inbound images with a size bounded LRU cache in memory and (optionally) on disk
+
+    Concurrent fetches of the same image share one download. Images are keyed by imageId if available,
+    so the same image reposted across groups is only downloaded once.
+    """
+
+    def __init__(self, session: HttpClient, cache_dir: Optional[Union[str, Path]] = None,
+                 memory_limit: int = 32 * 1024 * 1024, disk_limit: int = 512 * 1024 * 1024,
+                 memory_item_limit: int = 1024 * 1024, prefetch: bool = False):
+        """
+        Initialize ImageFetcher
+
+        :param session: HttpClient, the session of the Bot
+        :param cache_dir: directory for the disk cache, None to cache in memory only
+        :param memory_limit: maximum bytes of images cached in memory
+        :param disk_limit: maximum bytes of images cached on disk
+        :param memory_item_limit: images larger than this are only cached on disk
+        :param prefetch: bool, whether to download images as messages arrive (see Bot.prefetch_images)
+        """
+        self.session = session
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory_item_limit = memory_item_limit
+        self.prefetch = prefetch
+        self.logger = create_logger('ImageFetcher')
+        self.hits = 0
+        self.misses = 0
+        self._memory: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._memory_size = 0
+        self._disk: 'OrderedDict[str, int]' = OrderedDict()
+        self._disk_size = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._indexed: Optional[asyncio.Future] = None
+
+    async def _load_disk_index(self) -> None:
+        """
+        Internal use only, index existing files in cache_dir on first use
+        """
+        if self.cache_dir is None:
+            return
+        if self._indexed is None:
+            self._indexed = asyncio.ensure_future(self._index_disk())
+        await asyncio.shield(self._indexed)
+
+    async def _index_disk(self) -> None:
+        """
+        Internal use only, scan cache_dir off the event loop, least recently modified first
+        """
+        files = await asyncio.get_event_loop().run_in_executor(None, self._scan_disk, self.cache_dir)
+        for name, size in files:
+            if name not in self._disk:  # files downloaded while scanning stay the most recent
+                self._disk[name] = size
+                self._disk_size += size
+                self._disk.move_to_end(name, last=False)
+
+    @staticmethod
+    def _scan_disk(cache_dir: Path) -> List[Tuple[str, int]]:
+        """
+        Internal use only, runs in executor
+
+        :return: list of (file name, size), most recently modified first
+        """
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        files = [(f.stat(), f.name) for f in cache_dir.iterdir() if f.is_file() and f.suffix != '.tmp']
+        files.sort(key=lambda file: file[0].st_mtime)
+        return [(name, stat.st_size) for stat, name in reversed(files)]
+
+    @staticmethod
+    def _key(image: Union[Image, FlashImage, str]) -> str:
+        """
+        Internal use only, cache key of the image
+
+        :param image: Image, FlashImage or url
+        :return: hex digest of imageId (or url if imageId is not available)
+        """
+        if isinstance(image, str):
+            key = image
+        else:
+            key = image.imageId or image.url
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, body: bytes) -> None:
+        """
+        Internal use only, put the body in memory cache and evict least recently used images
+        """
+        if len(body) > self.memory_item_limit or key in self._memory:
+            return
+        self._memory[key] = body
+        self._memory_size += len(body)
+        while self._memory_size > self.memory_limit:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    async def _store(self, key: str, size: int) -> None:
+        """
+        Internal use only, index a downloaded file and evict least recently used files
+        """
+        self._disk[key] = size
+        self._disk_size += size
+        evicted = []
+        while self._disk_size > self.disk_limit and len(self._disk) > 1:
+            name, evicted_size = self._disk.popitem(last=False)
+            self._disk_size -= evicted_size
+            evicted.append(self.cache_dir / name)
+        if evicted:
+            await asyncio.get_event_loop().run_in_executor(None, self._remove_files, evicted)
+
+    def _remove_files(self, files: List[Path]) -> None:
+        """
+        Internal use only, runs in executor
+        """
+        for file in files:
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                self.logger.warning(f'Unable to remove cached image {file.name}')
+
+    @staticmethod
+    def _move_into_cache(temp: Path, target: Path) -> int:
+        """
+        Internal use only, runs in executor, move the downloaded file into cache_dir
+
+        :return: size of the file
+        """
+        try:
+            os.replace(temp, target)
+        finally:
+            if temp.exists():
+                os.remove(temp)
+        return target.stat().st_size
+
+    async def fetch_path(self, image: Union[Image, FlashImage, str]) -> Path:
+        """
+        Download the image to disk cache (if not cached) and return the path
+        Requires cache_dir
+
+        :param image: Image, FlashImage or url
+        :return: Path of the cached file
+        """
+        if self.cache_dir is None:
+            raise ValueError('cache_dir is required to fetch image to disk')
+        await self._load_disk_index()
+        key = self._key(image)
+        if key in self._disk:
+            self.hits += 1
+            self._disk.move_to_end(key)
+            return self.cache_dir / key
+        await self._download(key, image)
+        return self.cache_dir / key
+
+    async def fetch(self, image: Union[Image, FlashImage, str]) -> bytes:
+        """
+        Download the image (if not cached) and return the content
+
+        :param image: Image, FlashImage or url
+        :return: bytes
+        """
+        key = self._key(image)
+        body = self._memory.get(key)
+        if body is not None:
+            self.hits += 1
+            self._memory.move_to_end(key)
+            return body
+        await self._load_disk_index()
+        if key in self._disk:
+            self.hits += 1
+            self._disk.move_to_end(key)
+            body = await asyncio.get_event_loop().run_in_executor(None, (self.cache_dir / key).read_bytes)
+            self._remember(key, body)
+            return body
+        body = await self._download(key, image)
+        if body is None:  # streamed to disk
+            body = await asyncio.get_event_loop().run_in_executor(None, (self.cache_dir / key).read_bytes)
+            self._remember(key, body)
+        return body
+
+    async def _download(self, key: str, image: Union[Image, FlashImage, str]) -> Optional[bytes]:
+        """
+        Internal use only, download the image, concurrent calls for the same key share one download
+
+        :return: bytes if cached in memory only, None if streamed to disk
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        self.misses += 1
+        future = asyncio.ensure_future(self._do_download(key, image))
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _do_download(self, key: str, image: Union[Image, FlashImage, str]) -> Optional[bytes]:
+        """
+        Internal use only, download to memory, or stream to a temporary file and move it into cache_dir
+        """
+        url = image if isinstance(image, str) else image.url
+        if not url:
+            raise ValueError('Image does not have url')
+        if self.cache_dir is None:
+            body = await self.session.download(url)
+            self._remember(key, body)
+            return body
+        temp = self.cache_dir / f'{key}.tmp'
+        loop = asyncio.get_event_loop()
+        try:
+            await self.session.download(url, file=temp)
+        except BaseException:
+            await loop.run_in_executor(None, self._remove_files, [temp])
+            raise
+        size = await loop.run_in_executor(None, self._move_into_cache, temp, self.cache_dir / key)
+        await self._store(key, size)
+        return None
+
+    def prefetch_event(self, event: BaseEvent) -> None:
+        """
+        Start downloading all images in the message in background
+
+        :param event: the event, ignored if not a Message
+        """
+        if not isinstance(event, Message):
+            return
+        for component in event.messageChain:
+            if isinstance(component, (Image, FlashImage)) and component.url:
+                key = self._key(component)
+                if key not in self._memory and key not in self._disk:
+                    asyncio.ensure_future(self._prefetch(key, component))
+
+    async def _prefetch(self, key: str, image: Union[Image, FlashImage]) -> None:
+        """
+        Internal use only, download and log errors
+        """
+        try:
+            await self._load_disk_index()
+            if key in self._disk:
+                return
+            await self._download(key, image)
+        except Exception as e:
+            self.logger.warning(f'Unable to prefetch {image.url}: {e}')
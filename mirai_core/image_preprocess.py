@@ -0,0 +1,99 @@
+from typing import Dict, Optional, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import asyncio
+import hashlib
+import os
+from .log import create_logger
+
+
+def _preprocess(path: str, cache_dir: str, max_size: Tuple[int, int], image_format: str, quality: int) -> str:
+    """
+    Internal use only, runs in the process pool
+    Resize and recompress the image, the result is cached by content hash and options
+
+    :return: path of the processed image, or the original path if processing does not make it smaller
+    """
+    from PIL import Image
+
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha1(content)
+    digest.update(f'{max_size}{image_format}{quality}'.encode('utf-8'))
+    output = os.path.join(cache_dir, f'{digest.hexdigest()}.{image_format.lower()}')
+    if os.path.exists(output):
+        return output if os.path.getsize(output) < len(content) else path
+
+    with Image.open(path) as image:
+        if getattr(image, 'is_animated', False):  # keep animations as is
+            return path
+        image.thumbnail(max_size)
+        if image_format.upper() == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        temp = f'{output}.{os.getpid()}.tmp'
+        image.save(temp, format=image_format, quality=quality, optimize=True)
+    os.replace(temp, output)
+    return output if os.path.getsize(output) < len(content) else path
+
+
+class ImagePreprocessor:
+    """
+    Resize and recompress local images in a process pool before upload
+    Requires Pillow (pip install python-mirai-core[image])
+
+    Example:
+        bot = Bot(qq, host, port, verify_key, loop=loop, image_preprocessor=ImagePreprocessor(max_size=(1280, 1280)))
+    """
+
+    def __init__(self, cache_dir: Union[str, Path] = 'image_preprocess', max_size: Tuple[int, int] = (1920, 1920),
+                 image_format: str = 'JPEG', quality: int = 85, workers: Optional[int] = None):
+        """
+        Initialize ImagePreprocessor
+
+        :param cache_dir: directory for processed images
+        :param max_size: (width, height), images are scaled down to fit, aspect ratio is kept
+        :param image_format: target format supported by Pillow, such as 'JPEG', 'PNG' or 'WEBP'
+        :param quality: encoder quality, 1 to 95 for JPEG
+        :param workers: number of processes, defaults to number of cpus
+        """
+        try:
+            import PIL
+        except ImportError:
+            raise ImportError('Pillow is required for ImagePreprocessor, '
+                              'install it by pip install python-mirai-core[image]')
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = tuple(max_size)
+        self.image_format = image_format
+        self.quality = quality
+        self.logger = create_logger('ImagePreprocessor')
+        self._executor = ProcessPoolExecutor(workers)
+        self._inflight: Dict[Path, asyncio.Future] = {}
+
+    async def process(self, path: Union[str, Path]) -> Path:
+        """
+        Process the image off the event loop, concurrent calls for the same path share one job
+        If processing fails, the original image is used
+
+        :param path: path of the original image
+        :return: path of the image to upload
+        """
+        path = Path(path)
+        future = self._inflight.get(path)
+        if future is None:
+            future = asyncio.get_event_loop().run_in_executor(
+                self._executor, _preprocess,
+                str(path), str(self.cache_dir), self.max_size, self.image_format, self.quality)
+            self._inflight[path] = future
+            future.add_done_callback(lambda _: self._inflight.pop(path, None))
+        try:
+            return Path(await asyncio.shield(future))
+        except Exception:
+            self.logger.exception(f'Unable to preprocess {path}, uploading the original image')
+            return path
+
+    def close(self) -> None:
+        """
+        Shutdown the process pool
+        """
+        self._executor.shutdown(wait=False)
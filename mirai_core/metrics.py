@@ -0,0 +1,69 @@
+from typing import Sequence, Dict, Any
+from bisect import bisect_left
+
+
+class Histogram:
+    """
+    Fixed bucket histogram, values are usually durations in seconds
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        Initialize Histogram
+
+        :param buckets: sorted upper bounds of buckets, an overflow bucket is added automatically
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Record a value
+
+        :param value: the value
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate quantile by bucket upper bound
+
+        :param q: between 0 and 1
+        :return: upper bound of the bucket containing the quantile, max for the overflow bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Export the histogram
+
+        :return: dict contains count, sum, max, p50, p99 and buckets (upper bound to count, 'inf' for overflow)
+        """
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip([*map(str, self.buckets), 'inf'], self.counts))
+        }
+
+    def __repr__(self):
+        return f'<Histogram count={self.count} p50={self.quantile(0.5)} p99={self.quantile(0.99)} max={self.max}>'
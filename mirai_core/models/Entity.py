@@ -1,9 +1,13 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, ValidationError
+from typing import Optional, NamedTuple, Union, Any, Dict
+from collections import OrderedDict
 from enum import Enum
+import weakref
 
 
 class Friend(BaseModel):
+    __slots__ = ('__weakref__',)  # for EntityMap
+
     id: int
     nickname: str
     remark: Optional[str]
@@ -11,6 +15,16 @@ class Friend(BaseModel):
     def __repr__(self):
         return f"<Friend id={self.id} nickname='{self.nickname}' remark='{self.remark}'>"
 
+    @classmethod
+    def parse_trusted(cls, obj: dict) -> 'Friend':
+        """
+        Construct from trusted server data without validation
+
+        :param obj: the json
+        :return: Friend
+        """
+        return cls.construct(id=obj['id'], nickname=obj['nickname'], remark=obj.get('remark'))
+
     def get_avatar_url(self) -> str:
         return f'http://q4.qlogo.cn/g?b=qq&nk={self.id}&s=140'
 
@@ -22,6 +36,8 @@ class Permission(Enum):
 
 
 class Group(BaseModel):
+    __slots__ = ('__weakref__',)  # for EntityMap
+
     id: int
     name: str
     permission: Permission
@@ -29,11 +45,23 @@ class Group(BaseModel):
     def __repr__(self):
         return f"<Group id={self.id} name='{self.name}' permission={self.permission.name}>"
 
+    @classmethod
+    def parse_trusted(cls, obj: dict) -> 'Group':
+        """
+        Construct from trusted server data without validation, only permission is converted
+
+        :param obj: the json
+        :return: Group
+        """
+        return cls.construct(id=obj['id'], name=obj['name'], permission=Permission(obj['permission']))
+
     def get_avatar_url(self) -> str:
         return f'https://p.qlogo.cn/gh/{self.id}/{self.id}/'
 
 
 class Member(BaseModel):
+    __slots__ = ('__weakref__',)  # for EntityMap
+
     id: int
     memberName: str
     permission: Permission
@@ -42,10 +70,196 @@ class Member(BaseModel):
     def __repr__(self):
         return f"<Member id={self.id} group={self.group} permission={self.permission} group={self.group.id}>"
 
+    @classmethod
+    def parse_trusted(cls, obj: dict) -> 'Member':
+        """
+        Construct from trusted server data without validation, only permission and group are converted
+
+        :param obj: the json
+        :return: Member
+        """
+        return cls.construct(id=obj['id'],
+                             memberName=obj['memberName'],
+                             permission=Permission(obj['permission']),
+                             group=Group.parse_trusted(obj['group']))
+
+    @classmethod
+    def parse_with_group(cls, obj: dict, group: Group) -> 'Member':
+        """
+        Validate the fields of the member, and use the parsed group instead of obj['group']
+        Unlike parse_obj, the group is neither validated nor copied
+
+        :param obj: the json
+        :param group: Group, shared by members of the same group
+        :return: Member
+        """
+        values = {}
+        errors = []
+        for name, model_field in cls.__fields__.items():
+            if name == 'group':
+                continue
+            value, error = model_field.validate(obj.get(name), values, loc=name, cls=cls)
+            if error:
+                errors.append(error)
+            else:
+                values[name] = value
+        if errors:
+            raise ValidationError(errors, cls)
+        return cls.construct(**values, group=group)
+
     def get_avatar_url(self) -> str:
         return f'http://q4.qlogo.cn/g?b=qq&nk={self.id}&s=140'
 
 
+class MemberSummary(NamedTuple):
+    """
+    Compact projection of Member, see Bot.iter_members
+    """
+    id: int
+    memberName: str
+    permission: Permission
+
+
+class EntityMap:
+    """
+    Identity map of Group, Member and Friend, see Bot(intern_entities=True)
+
+    Parsing the same entity again returns the shared instance, with mutable fields (name, permission)
+    updated from the new data. An entity is shared as long as it is referenced, and the most recently seen
+    entities are kept even if not referenced, so that frequent senders and groups are not allocated again.
+    """
+
+    def __init__(self, keep: int = 4096):
+        """
+        Initialize EntityMap
+
+        :param keep: number of recently seen entities kept alive
+        """
+        self.keep = keep
+        self.hits = 0
+        self.misses = 0
+        self._entities: 'weakref.WeakValueDictionary[tuple, Union[Group, Member, Friend]]' = \
+            weakref.WeakValueDictionary()
+        self._recent: 'OrderedDict[tuple, Union[Group, Member, Friend]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entities)
+
+    def _get(self, key: tuple) -> Any:
+        """
+        Internal use only
+        """
+        entity = self._entities.get(key)
+        if entity is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            if key in self._recent:
+                self._recent.move_to_end(key)
+            else:
+                self._remember(key, entity)
+        return entity
+
+    def _remember(self, key: tuple, entity: Any) -> None:
+        """
+        Internal use only
+        """
+        self._recent[key] = entity
+        if len(self._recent) > self.keep:
+            self._recent.popitem(last=False)
+
+    def _add(self, key: tuple, entity: Any) -> Any:
+        """
+        Internal use only
+        """
+        self._entities[key] = entity
+        self._remember(key, entity)
+        return entity
+
+    def group(self, obj: Dict[str, Any]) -> Group:
+        """
+        Get the shared Group from trusted server data
+
+        :param obj: the json
+        :return: Group
+        """
+        key = ('group', obj['id'])
+        group = self._get(key)
+        if group is None:
+            return self._add(key, Group.parse_trusted(obj))
+        group.__dict__['name'] = obj['name']
+        group.__dict__['permission'] = Permission(obj['permission'])
+        return group
+
+    def member(self, obj: Dict[str, Any]) -> Member:
+        """
+        Get the shared Member from trusted server data
+
+        :param obj: the json
+        :return: Member
+        """
+        group = self.group(obj['group'])
+        key = ('member', group.id, obj['id'])
+        member = self._get(key)
+        if member is None:
+            return self._add(key, Member.construct(id=obj['id'], memberName=obj['memberName'],
+                                                   permission=Permission(obj['permission']), group=group))
+        member.__dict__['memberName'] = obj['memberName']
+        member.__dict__['permission'] = Permission(obj['permission'])
+        member.__dict__['group'] = group
+        return member
+
+    def friend(self, obj: Dict[str, Any]) -> Friend:
+        """
+        Get the shared Friend from trusted server data
+
+        :param obj: the json
+        :return: Friend
+        """
+        key = ('friend', obj['id'])
+        friend = self._get(key)
+        if friend is None:
+            return self._add(key, Friend.parse_trusted(obj))
+        friend.__dict__['nickname'] = obj['nickname']
+        friend.__dict__['remark'] = obj.get('remark')
+        return friend
+
+    def intern(self, entity: Union[Group, Member, Friend]) -> Union[Group, Member, Friend]:
+        """
+        Get the shared instance of a parsed entity, updated from it
+        The entity becomes the shared instance if there is none
+
+        :param entity: Group, Member or Friend
+        :return: the shared instance
+        """
+        if isinstance(entity, Member):
+            group = self.intern(entity.group)
+            key = ('member', group.id, entity.id)
+        elif isinstance(entity, Group):
+            key = ('group', entity.id)
+        else:
+            key = ('friend', entity.id)
+        shared = self._get(key)
+        if shared is None:
+            shared = self._add(key, entity)
+        elif shared is not entity:
+            shared.__dict__.update(entity.__dict__)
+        if isinstance(entity, Member):
+            shared.__dict__['group'] = group
+        return shared
+
+    def intern_fields(self, model: BaseModel) -> None:
+        """
+        Replace Group, Member and Friend fields of a parsed model (such as an event) by the shared instances
+
+        :param model: the model
+        """
+        fields = model.__dict__
+        for name, value in fields.items():
+            if isinstance(value, (Group, Member, Friend)):
+                fields[name] = self.intern(value)
+
+
 class MemberChangeableSetting(BaseModel):
     name: str
     specialTitle: str
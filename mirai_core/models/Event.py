@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, Extra, root_validator
-from .Entity import Permission, Group, Member, Friend
+from .Entity import Permission, Group, Member, Friend, EntityMap
 from .Message import MessageChain
 from .Types import MessageType
 from typing import Optional, Literal, Union, Type, Any
@@ -377,3 +377,32 @@ Events = events()
 class WebSocketEvent(BaseModel):
     sync_id: str = Field(..., alias="syncId")
     data: Events
+
+
+_message_types = {message_type.value for message_type in MessageType}
+
+
+def parse_trusted_event(obj: dict, entities: Optional[EntityMap] = None) -> Events:
+    """
+    Construct event from trusted server data (the data field of WebSocketEvent) without validation
+    Only message events are constructed directly, other events are rare and fully validated
+
+    :param obj: the json
+    :param entities: EntityMap, if set, senders and groups are the shared instances
+    :return: Events
+    """
+    if obj.get('type') in _message_types:
+        sender = obj['sender']
+        if entities is not None:
+            sender = entities.member(sender) if 'group' in sender else entities.friend(sender)
+        elif 'group' in sender:
+            sender = Member.parse_trusted(sender)
+        else:
+            sender = Friend.parse_trusted(sender)
+        return Message.construct(type=MessageType(obj['type']),
+                                 messageChain=MessageChain.parse_trusted(obj['messageChain']),
+                                 sender=sender)
+    event = WebSocketEvent.parse_obj({'syncId': '', 'data': obj}).data
+    if entities is not None:
+        entities.intern_fields(event)
+    return event
@@ -2,9 +2,7 @@ from abc import abstractmethod
 from enum import Enum
 from typing import List, Dict, Optional, overload, Iterable, Union, Literal, Type, Any
 from pydantic import Field, validator, HttpUrl, BaseModel, Extra, root_validator
-from .Constant import qq_emoji_text_list
 import datetime
-from collections import MutableSequence
 import json
 
 __all__ = [
@@ -137,11 +135,11 @@ class Face(BaseMessageComponent):
         super().__init__(faceId=faceId, **kwargs)
 
     def __str__(self):
-        return qq_emoji_text_list[self.faceId] if self.faceId in qq_emoji_text_list else "[Unknown]"
+        from .Constant import qq_emoji_text_list  # the table is only loaded when face text is needed
+        return qq_emoji_text_list.get(self.faceId, '[Unknown]')
 
     def __repr__(self):
-        face_text = qq_emoji_text_list[self.faceId] if self.faceId in qq_emoji_text_list else "[Unknown]"
-        return f'[Face: id={self.faceId}, {face_text}]'
+        return f'[Face: id={self.faceId}, {str(self)}]'
 
 
 class Image(BaseMessageComponent):
@@ -401,6 +399,16 @@ class QuoteMessageChain(BaseModel):
         assert isinstance(result, Source)
         return result
 
+    @classmethod
+    def parse_trusted(cls, obj: list) -> 'QuoteMessageChain':
+        """
+        Construct from trusted server data without validation
+
+        :param obj: the json
+        :return: QuoteMessageChain
+        """
+        return cls.construct(__root__=[parse_component_trusted(component) for component in obj])
+
 
 class Quote(BaseMessageComponent):
     """
@@ -498,6 +506,46 @@ class MessageChain(BaseModel):
             assert isinstance(result, Quote)
             return result
 
+    @classmethod
+    def parse_trusted(cls, obj: list) -> 'MessageChain':
+        """
+        Construct from trusted server data without validation
+
+        :param obj: the json
+        :return: MessageChain
+        """
+        return cls.construct(__root__=[parse_component_trusted(component) for component in obj])
+
+
+# component classes for parse_component_trusted, indexed by type
+_component_types = {
+    component_class.__fields__['type'].default: component_class
+    for component_class in (Source, Plain, Image, Quote, At, Face, FlashImage, AtAll, Xml, Json, App, Poke)
+}
+
+
+def parse_component_trusted(obj: dict) -> BaseMessageComponent:
+    """
+    Construct message component from trusted server data without validation
+    Only the fields used by this library (Source.time, Quote.origin, Poke.name) are converted,
+    components with aliased fields or unknown types are fully validated
+
+    :param obj: the json
+    :return: BaseMessageComponent
+    """
+    component_class = _component_types.get(obj.get('type'))
+    if component_class is None:
+        return BaseMessageComponent.parse_obj(obj)
+    elif component_class is Json:  # aliased field, Json(**obj) fails as in validated parsing
+        return BaseMessageComponent.parse_obj(obj)
+    elif component_class is Source:
+        return Source.construct(**{**obj, 'time': datetime.datetime.fromtimestamp(obj['time'], datetime.timezone.utc)})
+    elif component_class is Quote:
+        return Quote.construct(**{**obj, 'origin': QuoteMessageChain.parse_trusted(obj['origin'])})
+    elif component_class is Poke:
+        return Poke.construct(**{**obj, 'name': PokeChoices(obj['name'])})
+    return component_class.construct(**obj)
+
 
 class BotMessage(BaseModel):
     type: str = 'BotMessage'
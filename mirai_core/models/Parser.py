@@ -0,0 +1,164 @@
+from typing import Dict, Union, Iterable, Optional, Mapping, Tuple, List
+import string
+from .Entity import Member, Friend, MemberSummary
+from .Message import MessageChain, BaseMessageComponent, Plain, At, Face
+
+__all__ = [
+    'TextParser'
+]
+
+_END = ''  # trie key of the match at a node, no token contains an empty character
+_FACE = ('Face',)  # trie keys of the face and the name ending at a node, kept apart so that neither replaces the other
+_MENTION = ('At',)
+_WORD = frozenset(string.ascii_letters + string.digits + '_')  # characters that continue a word, such as a name
+
+
+class TextParser:
+    """
+    Convert text with face tokens ([微笑]) and mentions (@name) into MessageChain of Plain, Face and At
+    Available for outbound message
+
+    Faces and member names are compiled into one trie, parsing is a single pass over the text
+    that takes the longest token at each '[' or '@'. If a mention (mention_prefix + name) is also a face token,
+    the face is matched.
+    A mention is only matched at word boundaries: @Alic is not a mention of Al, and a@Alice.com is not a mention.
+    Words are ASCII letters, digits and underscore, so that a name can be followed by Chinese text without a space.
+
+    Example:
+        parser = TextParser(await bot.get_members(group))
+        await bot.send_message(group, MessageType.GROUP, parser.parse('@Alice 你好[微笑]'))
+    """
+
+    def __init__(self, members: Union[Iterable[Union[Member, MemberSummary, Friend]], Mapping[str, int], None] = None,
+                 faces: bool = True, mention_prefix: str = '@'):
+        """
+        Compile the parser
+
+        :param members: Member, MemberSummary or Friend list, or dict of name to qq number,
+               names are matched after mention_prefix. None to parse faces only
+        :param faces: bool, whether to parse face tokens in qq_emoji_text_list
+        :param mention_prefix: str, text before a member name
+        """
+        self.mention_prefix = mention_prefix
+        self._faces: Dict[str, int] = {}
+        if faces:
+            from .Constant import qq_emoji_text_list
+            for face_id, text in qq_emoji_text_list.items():
+                if text != '[Empty]':
+                    self._faces.setdefault(text, face_id)  # first id of duplicated text
+        self._names: Dict[str, int] = {}
+        self._trie: dict = {}
+        for text, face_id in self._faces.items():
+            self._insert(text, _FACE, ('Face', face_id))
+        if members is not None:
+            self.update_members(members)
+
+    def _insert(self, token: str, kind: tuple, value: Tuple[str, int]) -> None:
+        """
+        Internal use only
+        """
+        node = self._trie
+        for character in token:
+            node = node.setdefault(character, {})
+        node[kind] = value
+        node[_END] = node.get(_FACE, value)
+
+    def _remove(self, token: str, kind: tuple) -> None:
+        """
+        Internal use only
+        """
+        path = [self._trie]
+        for character in token:
+            path.append(path[-1][character])
+        node = path[-1]
+        del node[kind]
+        remaining = node.get(_FACE, node.get(_MENTION))
+        if remaining is not None:
+            node[_END] = remaining
+            return
+        del node[_END]
+        for character, node in zip(reversed(token), reversed(path[:-1])):  # prune empty branches
+            if node[character]:
+                break
+            del node[character]
+
+    def update_members(self, members: Union[Iterable[Union[Member, MemberSummary, Friend]], Mapping[str, int]]) -> None:
+        """
+        Replace the member name index
+
+        :param members: Member, MemberSummary or Friend list, or dict of name to qq number
+        """
+        if isinstance(members, Mapping):
+            names = dict(members)
+        else:
+            names = {}
+            for member in members:
+                name = member.nickname if isinstance(member, Friend) else member.memberName
+                names.setdefault(name, member.id)
+        for name in self._names:
+            self._remove(self.mention_prefix + name, _MENTION)
+        self._names = {name: qq for name, qq in names.items() if name}
+        for name, qq in self._names.items():
+            self._insert(self.mention_prefix + name, _MENTION, ('At', qq))
+
+    def tokenize(self, text: str) -> List[Union[str, Tuple[str, int]]]:
+        """
+        Split text into plain text and tokens
+
+        :param text: str
+        :return: list of str (plain text) and ('Face', face id) or ('At', qq number)
+        """
+        trie = self._trie
+        parts = []
+        plain_start = 0
+        position = 0
+        length = len(text)
+        while position < length:
+            node = trie.get(text[position])
+            if node is None:
+                position += 1
+                continue
+            match = None
+            end = position + 1
+            mention = position == 0 or text[position - 1] not in _WORD  # not inside a word such as an email address
+            while True:
+                value = node.get(_END)
+                if value is not None and (value[0] == 'Face' or mention and (
+                        end == length or text[end] not in _WORD or text[end - 1] not in _WORD)):
+                    match = (value, end)
+                if end == length:
+                    break
+                node = node.get(text[end])
+                if node is None:
+                    break
+                end += 1
+            if match is None:
+                position += 1
+                continue
+            if plain_start < position:
+                parts.append(text[plain_start:position])
+            parts.append(match[0])
+            position = plain_start = match[1]
+        if plain_start < length:
+            parts.append(text[plain_start:])
+        return parts
+
+    def parse(self, text: str) -> MessageChain:
+        """
+        Convert text into MessageChain
+
+        :param text: str
+        :return: MessageChain of Plain, Face and At
+        """
+        components: List[BaseMessageComponent] = []
+        for part in self.tokenize(text):
+            if isinstance(part, str):
+                components.append(Plain.construct(type='Plain', text=part))
+            elif part[0] == 'Face':
+                components.append(Face.construct(type='Face', faceId=part[1]))
+            else:
+                components.append(At.construct(type='At', target=part[1], display=''))
+        return MessageChain.construct(__root__=components)
+
+    def __repr__(self):
+        return f'[TextParser: {len(self._faces)} faces, {len(self._names)} names]'
@@ -0,0 +1,133 @@
+from typing import List, Dict, Union, Any, Iterable
+import json
+from .Message import BaseMessageComponent, MessageChain, Image, FlashImage
+
+__all__ = [
+    'Placeholder',
+    'MessageTemplate',
+    'RenderedMessage'
+]
+
+
+class Placeholder:
+    """
+    A variable part of a MessageTemplate, filled by keyword argument when rendering
+    Not a valid component for outbound message
+    """
+    kinds = ('Plain', 'At', 'Face', 'Image', 'FlashImage')
+
+    def __init__(self, name: str, kind: str = 'Plain'):
+        """
+        Construct placeholder
+
+        :param name: keyword name used in MessageTemplate.render
+        :param kind: 'Plain', 'At', 'Face', 'Image' or 'FlashImage', the component type to render into
+        """
+        if kind not in Placeholder.kinds:
+            raise ValueError(f'kind must be one of {", ".join(Placeholder.kinds)}')
+        self.name = name
+        self.kind = kind
+
+    def render(self, value) -> Dict[str, Any]:
+        """
+        Internal use only
+        Convert the value to serialized component without validation
+
+        :param value: str for Plain, int/Member/Friend for At, int for Face, str/Image for Image
+        :return: dict, the serialized component
+        """
+        if self.kind == 'Plain':
+            return {'type': 'Plain', 'text': str(value)}
+        elif self.kind == 'At':
+            target = value if isinstance(value, int) else value.id
+            return {'type': 'At', 'target': target, 'display': ''}
+        elif self.kind == 'Face':
+            return {'type': 'Face', 'faceId': int(value)}
+        if isinstance(value, (Image, FlashImage)):
+            if not value.imageId and not value.url:
+                raise ValueError('Image placeholder requires an uploaded image (imageId or url)')
+            return {'type': self.kind, 'imageId': value.imageId, 'url': value.url, 'path': None}
+        return {'type': self.kind, 'imageId': str(value), 'url': None, 'path': None}
+
+    def __repr__(self):
+        return f'[Placeholder: {self.name}, kind={self.kind}]'
+
+
+class RenderedMessage:
+    """
+    Serialized message chain produced by MessageTemplate.render
+    Can be passed to Bot.send_message directly, no further validation or upload is performed
+    Static components are shared between renders and must not be modified
+    """
+
+    def __init__(self, message_chain: List[Dict[str, Any]]):
+        self.message_chain = message_chain
+
+    def to_message_chain(self) -> MessageChain:
+        """
+        Build the validated MessageChain, mostly for debugging
+
+        :return: MessageChain
+        """
+        return MessageChain.parse_obj(self.message_chain)
+
+    def __repr__(self):
+        return f'[RenderedMessage: {json.dumps(self.message_chain, ensure_ascii=False)}]'
+
+
+class MessageTemplate:
+    """
+    Precompiled message chain with placeholders
+
+    Static components are validated and serialized once on construction,
+    rendering only substitutes the placeholders.
+
+    Example:
+        template = MessageTemplate([Placeholder('user', 'At'), Plain(' you have '), Placeholder('points'),
+                                    Plain(' points'), Image(imageId='{...}.jpg')])
+        await bot.send_message(group, MessageType.GROUP, template.render(user=member, points=10))
+
+    Images with only path set must be uploaded first, see Bot.compile_template
+    """
+
+    def __init__(self, message: Union[MessageChain, Iterable[Union[BaseMessageComponent, Placeholder, str]]]):
+        """
+        Compile the template
+
+        :param message: MessageChain, or list of BaseMessageComponent, Placeholder and str
+        """
+        self.placeholders: Dict[str, List[int]] = {}
+        self._parts: List[Union[Dict[str, Any], Placeholder]] = []
+        for component in message:
+            if isinstance(component, str):
+                self._parts.append({'type': 'Plain', 'text': component})
+            elif isinstance(component, Placeholder):
+                self.placeholders.setdefault(component.name, []).append(len(self._parts))
+                self._parts.append(component)
+            elif isinstance(component, BaseMessageComponent):
+                if isinstance(component, (Image, FlashImage)) and not component.imageId and not component.url:
+                    raise ValueError('Image in template must be uploaded first, use Bot.compile_template instead')
+                self._parts.append(json.loads(component.json()))
+            else:
+                raise ValueError(f'Invalid template component: {component}')
+        self._static = [None if isinstance(part, Placeholder) else part for part in self._parts]
+
+    def render(self, **values) -> RenderedMessage:
+        """
+        Substitute placeholders and return the serialized message chain
+
+        :param values: placeholder name to value
+        :return: RenderedMessage, pass to Bot.send_message as message
+        """
+        message_chain = self._static.copy()
+        for name, indexes in self.placeholders.items():
+            try:
+                value = values[name]
+            except KeyError:
+                raise ValueError(f'Missing value for placeholder {name}')
+            for index in indexes:
+                message_chain[index] = self._parts[index].render(value)
+        return RenderedMessage(message_chain)
+
+    def __repr__(self):
+        return f'[MessageTemplate: {", ".join(self.placeholders)}]'
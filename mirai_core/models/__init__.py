@@ -1,4 +1,22 @@
-from . import Message
-from . import Event
-from . import Entity
-from . import Constant
+from importlib import import_module
+
+__all__ = [
+    'Message',
+    'Event',
+    'Entity',
+    'Constant',
+    'Template',
+    'Parser',
+    'Types'
+]
+
+
+# submodules are imported on first access, building the pydantic models is the major cost of importing
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return import_module(f'.{name}', __name__)
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,12 +1,21 @@
-from typing import Dict
+from typing import Dict, Optional, Callable, Awaitable, Any, Tuple, AsyncIterator
+from contextlib import contextmanager
+import asyncio
+import codecs
+import json
+import re
 import aiohttp
 from aiohttp import client_exceptions
 from pathlib import Path
+from itertools import count
 from .log import create_logger
+from .resilience import CircuitBreaker, RetryBudget, backoff
+from .connection import WebsocketConnection
 from io import BytesIO
 
 from .exceptions import AuthenticationException, NetworkException, ServerException, \
-    UnknownTargetException, PrivilegeException, BadRequestException, MiraiException, SessionException
+    UnknownTargetException, PrivilegeException, BadRequestException, MiraiException, SessionException, \
+    MessageTooLongException, CircuitOpenException
 
 
 error_code = {
@@ -18,7 +27,7 @@ error_code = {
                 6: lambda: UnknownTargetException('File target does not exist'),
                 10: lambda: PrivilegeException('Bot does not have corresponding privilege'),
                 20: lambda: PrivilegeException('Bot is banned in group'),
-                30: lambda: PrivilegeException('Message is too long'),
+                30: lambda: MessageTooLongException('Message is too long'),
                 400: lambda: BadRequestException('Bad Request, please check arguments/url'),
             }
 
@@ -43,7 +52,17 @@ class HttpClient:
         """
         if result.status != 200:
             raise ServerException(f'{url} {method} failed, status code: {result.status}')
-        result = await result.json()
+        return HttpClient._check_result(await result.json(), method)
+
+    @staticmethod
+    def _check_result(result, method) -> Dict:
+        """
+        Check decoded response of http request or websocket command, and raise exceptions
+
+        :param result: json decoded response
+        :param method: 'post', 'get'
+        :return: json decoded result
+        """
         if not isinstance(result, dict):
             return result
         status_code = result.get('code')
@@ -60,12 +79,149 @@ class HttpClient:
         else:
             raise MiraiException('HTTP API updated, please upgrade python-mirai-core')
 
-    def __init__(self, base_url: str, timeout=DEFAULT_TIMEOUT, loop=None):
+    # sent over http even if websocket commands are enabled
+    HTTP_ONLY = {'/verify', '/bind', '/release', '/uploadImage'}
+    # commands with subCommand 'get' (http get) or 'update' (http post)
+    SUB_COMMANDS = {'/groupConfig', '/memberInfo', '/config'}
+
+    def __init__(self, base_url: str, timeout=DEFAULT_TIMEOUT, loop=None, max_retries: int = 2,
+                 websocket_commands: bool = False, heartbeat: float = DEFAULT_TIMEOUT, compression: bool = False):
+        """
+        Initialize HttpClient
+
+        :param base_url: url of mirai-api-http
+        :param timeout: seconds, request timeout
+        :param loop: the event loop
+        :param max_retries: maximum retries of an idempotent request, subject to retry_budget
+        :param websocket_commands: bool, whether get and post are sent as commands over an established websocket,
+               http is used if no websocket is connected
+        :param heartbeat: seconds between websocket pings, a websocket that does not answer in time is reconnected
+        :param compression: bool, whether to negotiate permessage-deflate for websockets and accept
+               gzip/deflate http responses (useful for remote consoles, costs cpu on both sides),
+               otherwise http responses are requested uncompressed (Accept-Encoding: identity)
+        """
         self.base_url = base_url
         self.timeout = aiohttp.ClientTimeout(timeout)
-        self.session = aiohttp.ClientSession(timeout=self.timeout, loop=loop)
+        self.compression = compression
+        self.session = aiohttp.ClientSession(timeout=self.timeout, loop=loop,
+                                             headers={'Accept-Encoding': 'gzip, deflate' if compression else 'identity'})
         self.logger = create_logger('Network')
         self.loop = loop
+        self.websockets = set()
+        self.requests_in_flight = 0
+        self.requests_completed = 0
+        self._idle_waiters = []
+        self.max_retries = max_retries
+        self.breaker = CircuitBreaker()
+        self.retry_budget = RetryBudget()
+        self.retries = 0
+        self.websocket_commands = websocket_commands
+        self.heartbeat = heartbeat
+        self.connections = set()
+        self.bytes_received = 0  # decoded http response bodies
+        self.bytes_transferred = 0  # http response bodies as transferred (compressed if the server compressed them)
+        self._command_ids = count(1)
+        self._pending_commands: Dict[str, Tuple[aiohttp.ClientWebSocketResponse, asyncio.Future]] = {}
+
+    @contextmanager
+    def _track_request(self):
+        """
+        Internal use only, count in flight requests for graceful shutdown
+        """
+        self.requests_in_flight += 1
+        try:
+            yield
+        finally:
+            self._request_finished()
+
+    def _request_finished(self, completed: bool = True) -> None:
+        """
+        Internal use only, the counterpart of requests_in_flight += 1
+
+        :param completed: bool, whether to count the request as completed (False if it is only paused)
+        """
+        self.requests_in_flight -= 1
+        if completed:
+            self.requests_completed += 1
+        if self.requests_in_flight == 0:
+            for waiter in self._idle_waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self._idle_waiters.clear()
+
+    async def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until there is no request in flight
+
+        :param timeout: maximum seconds to wait, None for no limit
+        :return: True if idle, False if timed out
+        """
+        if self.requests_in_flight == 0:
+            return True
+        waiter = asyncio.get_event_loop().create_future()
+        self._idle_waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _send(self, method: str, url: str, request: Callable[[], Awaitable[aiohttp.ClientResponse]],
+                    idempotent: bool) -> aiohttp.ClientResponse:
+        """
+        Internal use only, send the request through the circuit breaker
+        Idempotent requests are retried with jittered exponential backoff if the console is unreachable
+
+        :param method: 'get', 'post' or 'upload', for logging
+        :param url: the sub url, for logging
+        :param request: callable that sends the request and returns the response, called on every attempt
+        :param idempotent: bool, whether the request can be retried safely
+        :return: the response, body already read
+        """
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            permit = self.breaker.allow()
+            if not permit:
+                raise CircuitOpenException(f'{method} {url} rejected, Mirai console is unreachable')
+            try:
+                response = await request()
+                body = await response.read()
+            except (client_exceptions.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.breaker.record_failure(permit)
+                if not idempotent or attempt >= self.max_retries or not self.retry_budget.withdraw():
+                    raise NetworkException('Unable to reach Mirai console') from e
+                delay = backoff(attempt)
+                attempt += 1
+                self.retries += 1
+                self.logger.warning(f'{method} {url} failed ({type(e).__name__}), retrying in {delay:.2f} seconds')
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.cancel(permit)
+                raise
+            if response.status >= 500:
+                self.breaker.record_failure(permit)
+            else:
+                self.breaker.record_success(permit)
+            self.bytes_received += len(body)
+            if response.headers.get('Content-Encoding') and response.content_length is not None:
+                self.bytes_transferred += response.content_length
+            else:
+                self.bytes_transferred += len(body)
+            return response
+
+    def resilience_stats(self) -> Dict[str, Any]:
+        """
+        Get the state of the circuit breaker and retry budget
+
+        :return: dict of breaker (CircuitBreaker.snapshot()), retry_budget (RetryBudget.snapshot()) and retries
+        """
+        return {
+            'breaker': self.breaker.snapshot(),
+            'retry_budget': self.retry_budget.snapshot(),
+            'retries': self.retries,
+        }
 
     async def get(self, url, headers=None, params=None):
         """
@@ -78,28 +234,101 @@ class HttpClient:
         """
         if url != '/fetchMessage':
             self.logger.debug(f'get {url} with params: {str(params)}')
-        try:
-            response = await self.session.get(self.base_url + url, headers=headers, params=params)
-        except client_exceptions.ClientConnectorError:
-            raise NetworkException('Unable to reach Mirai console')
-        return await HttpClient._check_response(response, url, 'get')
+        ws = self._command_websocket(url)
+        if ws is not None:
+            return await self.command(ws, url, 'get', params)
+        with self._track_request():
+            response = await self._send('get', url, lambda: self.session.get(self.base_url + url, headers=headers,
+                                                                             params=params), idempotent=True)
+            return await HttpClient._check_response(response, url, 'get')
 
-    async def post(self, url, headers=None, data=None):
+    async def post(self, url, headers=None, data=None, idempotent=False):
         """
         send http post request
 
         :param url: the sub url
         :param headers: request headers
         :param data: post params
+        :param idempotent: bool, whether the request can be retried if the console is unreachable
         :return: json decoded response
         """
 
         self.logger.debug(f'post {url} with data: {str(data)}')
-        try:
-            response = await self.session.post(self.base_url + url, headers=headers, json=data)
-        except client_exceptions.ClientConnectorError:
-            raise NetworkException('Unable to reach Mirai console')
-        return await HttpClient._check_response(response, url, 'post')
+        ws = self._command_websocket(url)
+        if ws is not None:
+            return await self.command(ws, url, 'post', data)
+        with self._track_request():
+            response = await self._send('post', url, lambda: self.session.post(self.base_url + url, headers=headers,
+                                                                               json=data), idempotent=idempotent)
+            return await HttpClient._check_response(response, url, 'post')
+
+    def _command_websocket(self, url: str) -> Optional[aiohttp.ClientWebSocketResponse]:
+        """
+        Internal use only, get the websocket to send the command, None to use http
+
+        :param url: the sub url
+        """
+        if not self.websocket_commands or url in HttpClient.HTTP_ONLY:
+            return None
+        for ws in self.websockets:
+            if not ws.closed:
+                return ws
+        return None
+
+    async def command(self, ws: aiohttp.ClientWebSocketResponse, url: str, method: str, content: Optional[Dict]):
+        """
+        Send the request as websocket command, and wait for the response with the same syncId
+
+        :param ws: the websocket
+        :param url: the sub url, converted to command name
+        :param method: 'get' or 'post'
+        :param content: get params or post data
+        :return: json decoded response
+        """
+        command = url.lstrip('/').replace('/', '_')
+        sub_command = None
+        if url in HttpClient.SUB_COMMANDS:
+            sub_command = 'get' if method == 'get' else 'update'
+        sync_id = str(next(self._command_ids))
+        future = asyncio.get_event_loop().create_future()
+        self._pending_commands[sync_id] = (ws, future)
+        with self._track_request():
+            try:
+                await ws.send_json({'syncId': sync_id, 'command': command, 'subCommand': sub_command,
+                                    'content': content or {}})
+                result = await asyncio.wait_for(future, self.timeout.total)
+            except asyncio.TimeoutError:
+                raise NetworkException(f'Command {command} timed out')
+            except ConnectionResetError:
+                raise NetworkException('Websocket is closed')
+            finally:
+                self._pending_commands.pop(sync_id, None)
+            return HttpClient._check_result(result, method)
+
+    def _resolve_command(self, result) -> bool:
+        """
+        Internal use only, resolve the pending command if the websocket message is a command response
+
+        :param result: json decoded websocket message
+        :return: True if it is a command response
+        """
+        if not isinstance(result, dict) or not self._pending_commands:
+            return False
+        pending = self._pending_commands.get(str(result.get('syncId')))
+        if pending is None:
+            return False
+        future = pending[1]
+        if not future.done():
+            future.set_result(result.get('data'))
+        return True
+
+    def _fail_commands(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        """
+        Internal use only, fail pending commands sent over the closed websocket
+        """
+        for pending_ws, future in list(self._pending_commands.values()):
+            if pending_ws is ws and not future.done():
+                future.set_exception(NetworkException('Websocket closed before command response'))
 
     async def upload(self, url, file: Path, headers=None, data=None):
         """
@@ -113,44 +342,217 @@ class HttpClient:
         """
         if data is None:
             data = dict()
-        data['img'] = BytesIO(open(file, 'rb').read())
+        content = open(file, 'rb').read()
 
         headers = headers or {}
         headers["Content-Type"] = "multipart/form-data"
 
         self.logger.debug(f'upload {url} with file: {file}')
+        with self._track_request():
+            response = await self._send('upload', url, lambda: self.session.post(
+                self.base_url + url, headers=headers, data={**data, 'img': BytesIO(content)}), idempotent=True)
+            self.logger.debug(f'Image uploaded: {response.text}')
+            return await response.json()
+
+    async def iter_items(self, url: str, params=None, key: str = 'data', chunk_size: int = 65536) -> AsyncIterator[Any]:
+        """
+        Send http get request, and decode items of the array in response[key] while the response is received,
+        without holding the whole response in memory
+        The request only counts as in flight while reading, not while the consumer handles the items.
+        If the consumer stops early, the response is closed when the iterator is closed (aclose) or collected
+
+        :param url: the sub url
+        :param params: get params
+        :param key: key of the array in the response
+        :param chunk_size: bytes to read at a time
+        :return: async iterator of json decoded items
+        """
+        self.logger.debug(f'get {url} with params: {str(params)} (streaming)')
+        permit = self.breaker.allow()
+        if not permit:
+            raise CircuitOpenException(f'get {url} rejected, Mirai console is unreachable')
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        array_start = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+        separators = re.compile(r'[\s,]*')
+        buffer = ''
+        position = 0
+        prefix = None  # response before the array
+        finished = False
+        received = 0
+        self.requests_in_flight += 1
+        tracked = True
         try:
-            response = await self.session.post(self.base_url + url,
-                                               headers=headers, data=data)
+            try:
+                response = await self.session.get(self.base_url + url, params=params)
+            except (client_exceptions.ClientConnectionError, asyncio.TimeoutError):
+                self.breaker.record_failure(permit)
+                raise NetworkException('Unable to reach Mirai console')
+            except BaseException:
+                self.breaker.cancel(permit)
+                raise
+            self.breaker.record_success(permit)
+            async with response:
+                if response.status != 200:
+                    raise ServerException(f'{url} get failed, status code: {response.status}')
+                while True:
+                    chunk = await response.content.read(chunk_size)
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                    buffer = buffer[position:] + text_decoder.decode(chunk)
+                    position = 0
+                    if prefix is None:
+                        match = array_start.search(buffer)
+                        if match is None:
+                            continue
+                        prefix = buffer[:match.end()]
+                        position = match.end()
+                    items = []
+                    while not finished:
+                        position = separators.match(buffer, position).end()
+                        if position == len(buffer):
+                            break
+                        if buffer[position] == ']':
+                            finished = True
+                            break
+                        try:
+                            item, end = decoder.raw_decode(buffer, position)
+                        except json.JSONDecodeError:  # incomplete item, wait for next chunk
+                            break
+                        if end == len(buffer) and not isinstance(item, (dict, list, str)):
+                            break  # a number may continue in next chunk
+                        position = end
+                        items.append(item)
+                    if items:
+                        self._request_finished(completed=False)
+                        tracked = False
+                        for item in items:
+                            yield item
+                        self.requests_in_flight += 1
+                        tracked = True
+                buffer = buffer[position:] + text_decoder.decode(b'', final=True)
+        finally:
+            if tracked:
+                self._request_finished()
+        self.bytes_received += received
+        if response.headers.get('Content-Encoding') and response.content_length is not None:
+            self.bytes_transferred += response.content_length
+        else:
+            self.bytes_transferred += received
+        # check code and msg of the response without the array
+        if prefix is None:
+            HttpClient._check_result(json.loads(buffer), 'get')
+        elif not finished:
+            raise ServerException(f'{url} get failed, incomplete response')
+        else:
+            HttpClient._check_result(json.loads(prefix + buffer), 'get')
+
+    async def download(self, url: str, file: Optional[Path] = None, chunk_size: int = 65536,
+                       read_timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Download from absolute url (such as image url), using the same session
+        The total timeout of the session does not apply, a download only fails if the server stops sending
+
+        :param url: the absolute url
+        :param file: stream the body to this file instead of returning it, written off the event loop
+        :param chunk_size: bytes to read at a time when streaming to file
+        :param read_timeout: seconds to wait for each read, defaults to the timeout of the session
+        :return: the body, or None if streamed to file
+        """
+        self.logger.debug(f'download {url}')
+        loop = asyncio.get_event_loop()
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout.total,
+                                        sock_read=read_timeout if read_timeout is not None else self.timeout.total)
+        try:
+            async with self.session.get(url, timeout=timeout) as response:
+                if response.status != 200:
+                    raise ServerException(f'{url} download failed, status code: {response.status}')
+                if file is None:
+                    return await response.read()
+                f = await loop.run_in_executor(None, open, file, 'wb')
+                try:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        await loop.run_in_executor(None, f.write, chunk)
+                finally:
+                    await loop.run_in_executor(None, f.close)
         except client_exceptions.ClientConnectorError:
+            raise NetworkException(f'Unable to reach {url}')
+        except asyncio.TimeoutError:
+            raise NetworkException(f'Timed out downloading {url}')
+
+    async def connect_websocket(self, url: str) -> aiohttp.ClientWebSocketResponse:
+        """
+        Internal use only, open websocket through the circuit breaker
+        Pings are not answered automatically, see WebsocketConnection
+
+        :param url: the sub url
+        :return: the websocket
+        """
+        permit = self.breaker.allow()
+        if not permit:
+            raise CircuitOpenException(f'websocket {url.split("?", 1)[0]} rejected, Mirai console is unreachable')
+        try:
+            ws = await self.session.ws_connect(self.base_url + url, autoping=False,
+                                               compress=15 if self.compression else 0)
+        except (client_exceptions.ClientConnectionError, asyncio.TimeoutError):
+            self.breaker.record_failure(permit)
             raise NetworkException('Unable to reach Mirai console')
-        self.logger.debug(f'Image uploaded: {response.text}')
-        return await response.json()
+        except BaseException:
+            self.breaker.cancel(permit)
+            raise
+        self.breaker.record_success(permit)
+        return ws
 
-    async def websocket(self, url: str, handler: callable, ws_close_handler: callable):
+    async def websocket(self, url: str, handler: callable, ws_close_handler: callable, reconnect: bool = False,
+                        on_reconnect: Optional[Callable[[], Awaitable[None]]] = None):
         """
         Create websocket subscriber to url
 
         :param url: the sub url
         :param handler: request headers
         :param ws_close_handler: callback for connection close
+        :param reconnect: bool, whether to reconnect with backoff until close_websockets is called,
+               ws_close_handler is only called after that
+        :param on_reconnect: callable, awaited before each reconnection, such as Bot.handshake
         """
+        connection = WebsocketConnection(self, url, handler, reconnect=reconnect, on_reconnect=on_reconnect,
+                                         heartbeat=self.heartbeat)
+        self.connections.add(connection)
         try:
-            ws = await self.session.ws_connect(self.base_url + url, heartbeat=HttpClient.DEFAULT_TIMEOUT)
-            self.logger.debug('Websocket established')
-            while True:
-                msg = await ws.receive()
-                if msg.type == aiohttp.WSMsgType.TEXT:
-                    self.logger.debug(f'Websocket received {msg}')
-                    await handler(msg.json())
-                elif msg.type == aiohttp.WSMsgType.CLOSED:
-                    self.logger.debug('Websocket closed')
-                    await ws_close_handler()
-                    return
-                else:
-                    self.logger.warning(f'Received unexpected type: {msg.type}')
-        except client_exceptions.ClientConnectorError:
-            raise NetworkException('Unable to reach Mirai console')
+            await connection.run()
+        finally:
+            self.connections.discard(connection)
+        await ws_close_handler()
+
+    async def close_websockets(self):
+        """
+        Close all websockets, the ws_close_handler of each websocket is called
+        """
+        for connection in list(self.connections):
+            await connection.close()
+
+    def compression_stats(self) -> Dict[str, Any]:
+        """
+        Get bytes received over http and characters received over websockets
+        Compressed size of websocket frames is not exposed by aiohttp, only whether compression is negotiated
+
+        :return: dict of http (received, transferred) and websocket (sub url to received characters and compress,
+                 the negotiated window bits or 0)
+        """
+        return {
+            'http': {'received': self.bytes_received, 'transferred': self.bytes_transferred},
+            'websocket': {connection.name: {'received': connection.chars_received, 'compress': connection.compress}
+                          for connection in self.connections},
+        }
+
+    def websocket_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get metrics of websocket connections
+
+        :return: dict of sub url to WebsocketConnection.stats()
+        """
+        return {connection.name: connection.stats() for connection in self.connections}
 
     async def close(self):
         """
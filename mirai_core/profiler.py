@@ -0,0 +1,241 @@
+from typing import Dict, Optional, Awaitable, List, Set, Tuple
+from collections import defaultdict
+from pathlib import Path
+import asyncio
+import cProfile
+import re
+import pstats
+import time
+import tracemalloc
+from .log import create_logger
+
+
+class HandlerProfile:
+    """
+    Aggregated cost of one handler within a profiling window
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.cpu_time = 0.0  # seconds of cpu time spent in the handler itself (awaits excluded)
+        self.wall_time = 0.0  # seconds from start to finish, awaits included
+        self.allocated = 0  # bytes, sum of net allocations of each step, only if allocations are traced
+        self.profile = cProfile.Profile()
+
+    def __repr__(self):
+        return f'<HandlerProfile {self.name} calls={self.calls} cpu={self.cpu_time:.6f}s ' \
+               f'wall={self.wall_time:.6f}s allocated={self.allocated}>'
+
+
+class _ProfiledCoroutine:
+    """
+    Internal use only
+    Drive the handler coroutine step by step, and attribute cost of each step to the handler
+    in the window the step runs in, a window that has been rotated out is no longer touched
+    """
+
+    def __init__(self, coro, profiler: 'HandlerProfiler', name: str):
+        self._coro = coro
+        self._profiler = profiler
+        self._name = name
+        self._trace_allocations = profiler.trace_allocations
+        self._start = None
+        self._window = None
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        return self._step(self._coro.send, value)
+
+    def throw(self, *args):
+        return self._step(self._coro.throw, *args)
+
+    def close(self):
+        return self._coro.close()
+
+    def _step(self, method, *args):
+        profile = self._profiler._get_profile(self._name)
+        if self._start is None:
+            self._start = time.perf_counter()
+        if self._window is not profile:  # first step, or first step in a new window
+            self._window = profile
+            profile.calls += 1
+        allocated = tracemalloc.get_traced_memory()[0] if self._trace_allocations else 0
+        cpu_start = time.thread_time()
+        profile.profile.enable()
+        try:
+            return method(*args)
+        except BaseException:  # StopIteration included, the handler is finished
+            profile.wall_time += time.perf_counter() - self._start
+            raise
+        finally:
+            profile.profile.disable()
+            profile.cpu_time += time.thread_time() - cpu_start
+            if self._trace_allocations:
+                profile.allocated += max(0, tracemalloc.get_traced_memory()[0] - allocated)
+
+
+class HandlerProfiler:
+    """
+    Attribute cpu time, wall time and allocations to event handlers
+
+    Results are aggregated over a window, then written to output_dir as one pstats file per handler
+    and a collapsed stack file (handler;caller;...;function cpu_microseconds), which can be rendered by flamegraph.pl.
+    Files of a finished window are written by the default executor, not by the handler that starts the next window
+    """
+
+    def __init__(self, output_dir: str = 'profiles', window: float = 60, trace_allocations: bool = False):
+        """
+        Initialize HandlerProfiler
+
+        :param output_dir: directory for the output files
+        :param window: seconds to aggregate before writing results
+        :param trace_allocations: bool, whether to trace allocations with tracemalloc (expensive)
+        """
+        self.output_dir = Path(output_dir)
+        self.window = window
+        self.trace_allocations = trace_allocations
+        self.profiles: Dict[str, HandlerProfile] = {}
+        self.logger = create_logger('Profiler')
+        self._window_start = time.monotonic()
+        self._writes: Set[asyncio.Future] = set()
+        self._started_tracemalloc = False
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def wrap(self, name: str, coro) -> Awaitable:
+        """
+        Wrap the coroutine of a handler call
+
+        :param name: handler name
+        :param coro: the coroutine returned by the handler
+        :return: awaitable
+        """
+        self._get_profile(name)
+        return _ProfiledCoroutine(coro, self, name)
+
+    def flush(self) -> Optional[Path]:
+        """
+        Write results of current window and start a new window
+
+        :return: path of the collapsed stack file, None if nothing was recorded
+        """
+        return self._write(*self._next_window())
+
+    def _get_profile(self, name: str) -> HandlerProfile:
+        """
+        Internal use only
+        Return the profile of the handler in current window, the finished window is handed to the default executor
+        """
+        if time.monotonic() - self._window_start >= self.window:
+            future = asyncio.get_event_loop().run_in_executor(None, self._write, *self._next_window())
+            self._writes.add(future)
+            future.add_done_callback(self._written)
+        profile = self.profiles.get(name)
+        if profile is None:
+            profile = self.profiles[name] = HandlerProfile(name)
+        return profile
+
+    def _next_window(self) -> Tuple[List[Tuple[HandlerProfile, Optional[pstats.Stats]]], str]:
+        """
+        Internal use only, start a new window and return the profiles and file prefix of the finished one
+        Stats are built here on the loop thread, the cProfile.Profile objects are not used by other threads
+        """
+        profiles, self.profiles = self.profiles, {}
+        self._window_start = time.monotonic()
+        snapshots = []
+        for profile in profiles.values():
+            try:
+                stats = pstats.Stats(profile.profile)
+            except TypeError:  # no function call recorded
+                stats = None
+            snapshots.append((profile, stats))
+        return snapshots, time.strftime('%Y%m%d-%H%M%S')
+
+    def _written(self, future: asyncio.Future) -> None:
+        """
+        Internal use only
+        """
+        self._writes.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error('Unable to write profiles', exc_info=future.exception())
+
+    def _write(self, snapshots: List[Tuple[HandlerProfile, Optional[pstats.Stats]]],
+               prefix: str) -> Optional[Path]:
+        """
+        Internal use only, write pstats and collapsed stack files of a window
+        """
+        if not snapshots:
+            return None
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        collapsed = []
+        for profile, stats in snapshots:
+            self.logger.info(repr(profile))
+            if stats is None:
+                continue
+            file_name = re.sub(r'[^\w.-]', '_', profile.name)
+            stats.dump_stats(str(self.output_dir / f'{prefix}-{file_name}.pstats'))
+            collapsed.extend(collapse_stacks(stats, profile.name))
+        path = self.output_dir / f'{prefix}.collapsed'
+        path.write_text('\n'.join(collapsed) + '\n', 'utf-8')
+        return path
+
+    def close(self) -> Optional[Path]:
+        """
+        Write remaining results and stop tracing allocations
+
+        :return: path of the collapsed stack file, None if nothing was recorded
+        """
+        path = self.flush()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        return path
+
+
+def collapse_stacks(stats: pstats.Stats, root: str, max_depth: int = 64) -> List[str]:
+    """
+    Rebuild call stacks from the caller of each function recorded by cProfile, as collapsed stack lines
+    cProfile only records pairs of caller and callee, so the time of a function reached by several stacks is split
+    by the cumulative time of each call. Recursive calls are attributed to the outermost call
+
+    :param stats: pstats.Stats
+    :param root: name of the root frame, such as the handler name
+    :param max_depth: maximum stack depth
+    :return: list of 'root;caller;...;function cpu_microseconds'
+    """
+    entries = stats.stats
+    callees = defaultdict(list)
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller, (_, _, _, edge_cumulative) in callers.items():
+            callees[caller].append((function, edge_cumulative))
+    lines = []
+
+    def walk(function, stack: str, share: float, path: Tuple) -> None:
+        _, _, total_time, cumulative_time, _ = entries[function]
+        microseconds = int(total_time * share * 1e6)
+        if microseconds:
+            lines.append(f'{stack} {microseconds}')
+        if len(path) >= max_depth:
+            return
+        for callee, edge_cumulative in callees[function]:
+            callee_cumulative = entries[callee][3]
+            if callee in path or edge_cumulative * share < 1e-6:  # recursion, or too little time to show
+                continue
+            filename, line, name = callee
+            walk(callee, f'{stack};{name} ({filename}:{line})', min(1.0, share * edge_cumulative / callee_cumulative),
+                 path + (callee,))
+
+    for function, (_, _, _, _, callers) in entries.items():
+        if not callers:  # entered while profiling was enabled, such as the handler coroutine
+            filename, line, name = function
+            walk(function, f'{root};{name} ({filename}:{line})', 1.0, (function,))
+    return lines
@@ -0,0 +1,199 @@
+from typing import Dict, Any, Optional
+import random
+import time
+
+
+def backoff(attempt: int, base: float = 0.5, cap: float = 30) -> float:
+    """
+    Exponential backoff with full jitter
+
+    :param attempt: number of failed attempts so far, starting from 0
+    :param base: seconds, upper bound of the first delay
+    :param cap: seconds, maximum upper bound
+    :return: seconds to wait, uniformly random in [0, min(cap, base * 2 ** attempt)]
+    """
+    return random.uniform(0, min(cap, base * 2 ** min(attempt, 32)))
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the Mirai console is unreachable
+
+    After failure_threshold consecutive failures the breaker opens and requests are rejected without being sent.
+    After reset_timeout one probe request is allowed (half open), its success closes the breaker,
+    its failure opens the breaker again with doubled reset_timeout (up to max_reset_timeout).
+    The permit returned by allow identifies the probe, pass it to record_success, record_failure or cancel.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 5, max_reset_timeout: float = 60):
+        """
+        Initialize CircuitBreaker
+
+        :param failure_threshold: consecutive failures before the breaker opens
+        :param reset_timeout: seconds before the first probe
+        :param max_reset_timeout: maximum seconds between probes
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0  # consecutive failures
+        self.opened = 0  # times the breaker has opened
+        self.rejected = 0  # requests rejected while open
+        self._current_timeout = reset_timeout
+        self._opened_at = 0.0
+        self._probe: Optional[object] = None  # permit of the probe in flight
+
+    def allow(self) -> Any:
+        """
+        Check whether a request may be sent, call record_success or record_failure with the outcome
+
+        :return: a truthy permit if the request may be sent (the probe has its own permit), False otherwise
+        """
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        if self.state == CircuitBreaker.OPEN and time.monotonic() - self._opened_at >= self._current_timeout:
+            self.state = CircuitBreaker.HALF_OPEN
+        if self.state == CircuitBreaker.HALF_OPEN and self._probe is None:
+            self._probe = object()
+            return self._probe
+        self.rejected += 1
+        return False
+
+    def record_success(self, permit: Any = None) -> None:
+        """
+        Record a successful request
+
+        :param permit: the permit returned by allow
+        """
+        self.failures = 0
+        self._release(permit)
+        if self.state != CircuitBreaker.CLOSED:
+            self.state = CircuitBreaker.CLOSED
+            self._current_timeout = self.reset_timeout
+
+    def record_failure(self, permit: Any = None) -> None:
+        """
+        Record a failed request
+        While half open, only the failure of the probe opens the breaker again
+
+        :param permit: the permit returned by allow
+        """
+        self.failures += 1
+        probe = self._release(permit)
+        if self.state == CircuitBreaker.HALF_OPEN:
+            if probe:
+                self._current_timeout = min(self._current_timeout * 2, self.max_reset_timeout)
+                self._open()
+        elif self.state == CircuitBreaker.CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def cancel(self, permit: Any = None) -> None:
+        """
+        Record a request that finished without a conclusive outcome (cancelled or unexpected error)
+        If it was the probe, another probe is allowed
+
+        :param permit: the permit returned by allow
+        """
+        self._release(permit)
+
+    def _release(self, permit: Any) -> bool:
+        """
+        Internal use only, release the probe if the permit is the probe, or if no permit is given
+
+        :return: bool, whether the probe is released
+        """
+        if permit is None or permit is self._probe:
+            self._probe = None
+            return True
+        return False
+
+    def _open(self) -> None:
+        """
+        Internal use only
+        """
+        self.state = CircuitBreaker.OPEN
+        self.opened += 1
+        self._opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get the state of the breaker
+
+        :return: dict of state, failures, opened, rejected and retry_in (seconds until next probe, 0 if not open)
+        """
+        retry_in = 0.0
+        if self.state == CircuitBreaker.OPEN:
+            retry_in = max(0.0, self._opened_at + self._current_timeout - time.monotonic())
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opened': self.opened,
+            'rejected': self.rejected,
+            'retry_in': retry_in,
+        }
+
+
+class RetryBudget:
+    """
+    Limit retries to a ratio of requests, so retries cannot multiply the load on a struggling console
+
+    Each request deposits ratio tokens, each retry withdraws one token.
+    Tokens are also refilled at min_per_second, so that a few retries are allowed when traffic is low.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 1, max_tokens: float = 10):
+        """
+        Initialize RetryBudget
+
+        :param ratio: retries allowed per request
+        :param min_per_second: retries allowed per second regardless of traffic
+        :param max_tokens: maximum tokens that can be saved
+        """
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.exhausted = 0  # retries denied
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        """
+        Internal use only
+        """
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self) -> None:
+        """
+        Record a request
+        """
+        self._refill()
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """
+        Take a token for a retry
+
+        :return: True if the retry is allowed
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted += 1
+        return False
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get the state of the budget
+
+        :return: dict of tokens and exhausted
+        """
+        self._refill()
+        return {'tokens': self.tokens, 'exhausted': self.exhausted}
@@ -0,0 +1,302 @@
+from typing import Dict, Optional, Iterable, Union, Tuple
+from pathlib import Path
+from .log import create_logger
+from .models.Entity import Group, Member, MemberSummary, Permission
+from .exceptions import MiraiException
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# permission codes stored in the permission column, ordered so that admins are code >= 1
+PERMISSION_CODES = {
+    Permission.Member:        0,
+    Permission.Administrator: 1,
+    Permission.Owner:         2,
+}
+FORMAT_VERSION = 1
+
+
+class Roster:
+    """
+    Columnar store of group members across all groups, for vectorized queries
+    Requires NumPy (pip install python-mirai-core[roster])
+
+    Rows are (member id, group id, permission code), one per membership, sorted by group id then member id.
+    Queries return NumPy arrays instead of Member models.
+
+    Example:
+        roster = Roster()
+        await roster.refresh(bot)
+        admins, groups = roster.admins()
+        members, counts = roster.members_in_groups(more_than=5)
+        roster.save('roster.npz')
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty Roster
+        """
+        if np is None:
+            raise ImportError('NumPy is required for Roster, '
+                              'install it by pip install python-mirai-core[roster]')
+        self.logger = create_logger('Roster')
+        # group id -> (member ids, permission codes), columns are concatenated from these on query
+        self._groups: Dict[int, Tuple['np.ndarray', 'np.ndarray']] = {}
+        self._columns: Optional[Tuple['np.ndarray', 'np.ndarray', 'np.ndarray']] = None
+
+    @classmethod
+    def from_members(cls, members: Iterable[Member]) -> 'Roster':
+        """
+        Build from members of any groups, such as results of Bot.get_members
+
+        :param members: iterable of Member
+        :return: Roster
+        """
+        by_group: Dict[int, list] = {}
+        for member in members:
+            by_group.setdefault(member.group.id, []).append(member)
+        roster = cls()
+        for group_id, group_members in by_group.items():
+            roster.update(group_id, group_members)
+        return roster
+
+    def update(self, group: Union[Group, int], members: Iterable[Union[Member, MemberSummary]]) -> None:
+        """
+        Replace the members of a group
+
+        :param group: int or Group
+        :param members: iterable of Member or MemberSummary, all members of the group
+        """
+        group_id = group if isinstance(group, int) else group.id
+        rows = [(member.id, PERMISSION_CODES[member.permission]) for member in members]
+        member_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        permissions = np.fromiter((row[1] for row in rows), dtype=np.int8, count=len(rows))
+        order = np.argsort(member_ids, kind='stable')
+        self._groups[group_id] = (member_ids[order], permissions[order])
+        self._columns = None
+
+    def remove(self, group: Union[Group, int], member: Union[Member, int, None] = None) -> None:
+        """
+        Remove a member from a group, or the whole group if member is None
+        Call this for MemberLeaveEvent, BotLeaveEvent and similar events
+
+        :param group: int or Group
+        :param member: int or Member, or None
+        """
+        group_id = group if isinstance(group, int) else group.id
+        if group_id not in self._groups:
+            return
+        if member is None:
+            del self._groups[group_id]
+        else:
+            member_id = member if isinstance(member, int) else member.id
+            member_ids, permissions = self._groups[group_id]
+            keep = member_ids != member_id
+            self._groups[group_id] = (member_ids[keep], permissions[keep])
+        self._columns = None
+
+    async def refresh(self, bot, groups: Optional[Iterable[Union[Group, int]]] = None) -> None:
+        """
+        Fetch members of the groups, like Bot.iter_members(compact=True)
+        A group that fails to load keeps its stored members, a failure is logged instead of raised
+
+        :param bot: the Bot object to use
+        :param groups: groups to fetch, defaults to all joined groups (groups that are no longer joined are removed,
+               unless the group list fails to load, then the stored groups are fetched)
+        """
+        if groups is None:
+            try:
+                joined = await bot.get_groups()  # None if retry_once gave up
+            except MiraiException as e:
+                self.logger.warning(f'Unable to get joined groups ({e!r})')
+                joined = None
+            if joined is None:
+                self.logger.warning('Joined groups are unknown, refreshing stored groups only')
+                groups = list(self._groups)
+            else:
+                for group_id in set(self._groups) - {group.id for group in joined}:
+                    del self._groups[group_id]
+                self._columns = None
+                groups = joined
+        for group in groups:
+            try:
+                # unlike iter_members, raises instead of ending early, so a failure is not taken as an empty group
+                members = [member async for member in bot._iter_members(group, True, True)]
+            except MiraiException as e:
+                self.logger.warning(f'Unable to get members of group {group if isinstance(group, int) else group.id} '
+                                    f'({e!r}), keeping stored members')
+                continue
+            self.update(group, members)
+
+    @property
+    def columns(self) -> Tuple['np.ndarray', 'np.ndarray', 'np.ndarray']:
+        """
+        The (member ids, group ids, permission codes) columns, sorted by group id then member id
+        Do not modify the arrays
+        """
+        if self._columns is None:
+            group_ids = sorted(self._groups)
+            parts = [self._groups[group_id] for group_id in group_ids]
+            sizes = [len(member_ids) for member_ids, _ in parts]
+            self._columns = (
+                np.concatenate([member_ids for member_ids, _ in parts]) if parts else np.empty(0, np.int64),
+                np.repeat(np.array(group_ids, dtype=np.int64), sizes),
+                np.concatenate([permissions for _, permissions in parts]) if parts else np.empty(0, np.int8),
+            )
+        return self._columns
+
+    @property
+    def groups(self) -> 'np.ndarray':
+        """
+        Sorted ids of the stored groups
+        """
+        return np.array(sorted(self._groups), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return sum(len(member_ids) for member_ids, _ in self._groups.values())
+
+    def __contains__(self, group: Union[Group, int]) -> bool:
+        return (group if isinstance(group, int) else group.id) in self._groups
+
+    def members_of(self, group: Union[Group, int]) -> 'np.ndarray':
+        """
+        Get member ids of a group
+
+        :param group: int or Group
+        :return: sorted array of member ids, empty if the group is not stored
+        """
+        group_id = group if isinstance(group, int) else group.id
+        if group_id not in self._groups:
+            return np.empty(0, np.int64)
+        return self._groups[group_id][0]
+
+    def groups_of(self, member: Union[Member, int]) -> 'np.ndarray':
+        """
+        Get the groups a member is in
+
+        :param member: int or Member
+        :return: sorted array of group ids
+        """
+        member_id = member if isinstance(member, int) else member.id
+        member_ids, group_ids, _ = self.columns
+        return group_ids[member_ids == member_id]
+
+    def contains(self, group: Union[Group, int], members: Iterable[int]) -> 'np.ndarray':
+        """
+        Check membership of many members in a group
+
+        :param group: int or Group
+        :param members: iterable of member ids
+        :return: bool array, in the order of members
+        """
+        member_ids = self.members_of(group)
+        query = np.asarray(members if isinstance(members, np.ndarray) else list(members), dtype=np.int64)
+        if not len(member_ids):
+            return np.zeros(len(query), dtype=bool)
+        index = np.minimum(np.searchsorted(member_ids, query), len(member_ids) - 1)
+        return member_ids[index] == query
+
+    def common_members(self, groups: Iterable[Union[Group, int]]) -> 'np.ndarray':
+        """
+        Get members that are in all of the groups
+
+        :param groups: iterable of int or Group
+        :return: sorted array of member ids
+        """
+        group_ids = {group if isinstance(group, int) else group.id for group in groups}
+        if not group_ids or not group_ids <= set(self._groups):
+            return np.empty(0, np.int64)
+        # member ids are unique within a group, so a member in all groups appears len(group_ids) times
+        member_ids = np.concatenate([self._groups[group_id][0] for group_id in group_ids])
+        unique, counts = np.unique(member_ids, return_counts=True)
+        return unique[counts == len(group_ids)]
+
+    def common_groups(self, members: Iterable[Union[Member, int]]) -> 'np.ndarray':
+        """
+        Get groups that contain all of the members
+
+        :param members: iterable of int or Member
+        :return: sorted array of group ids
+        """
+        query = np.unique(np.array([member if isinstance(member, int) else member.id for member in members],
+                                   dtype=np.int64))
+        if not len(query):
+            return np.empty(0, np.int64)
+        member_ids, group_ids, _ = self.columns
+        selected = group_ids[np.isin(member_ids, query)]
+        unique, counts = np.unique(selected, return_counts=True)
+        return unique[counts == len(query)]
+
+    def with_permission(self, permission: Permission, at_least: bool = False,
+                        groups: Optional[Iterable[Union[Group, int]]] = None) -> Tuple['np.ndarray', 'np.ndarray']:
+        """
+        Get memberships with the permission
+
+        :param permission: Permission
+        :param at_least: bool, also include higher permissions (Owner is higher than Administrator)
+        :param groups: iterable of int or Group to search in, defaults to all groups
+        :return: (member ids, group ids), aligned arrays, sorted by group id then member id
+        """
+        member_ids, group_ids, permissions = self.columns
+        code = PERMISSION_CODES[permission]
+        mask = permissions >= code if at_least else permissions == code
+        if groups is not None:
+            mask &= np.isin(group_ids, [group if isinstance(group, int) else group.id for group in groups])
+        return member_ids[mask], group_ids[mask]
+
+    def admins(self, groups: Optional[Iterable[Union[Group, int]]] = None) -> Tuple['np.ndarray', 'np.ndarray']:
+        """
+        Get administrators and owners
+
+        :param groups: iterable of int or Group to search in, defaults to all groups
+        :return: (member ids, group ids), aligned arrays
+        """
+        return self.with_permission(Permission.Administrator, at_least=True, groups=groups)
+
+    def members_in_groups(self, more_than: int = 1) -> Tuple['np.ndarray', 'np.ndarray']:
+        """
+        Get members that are in more than the given number of stored groups
+
+        :param more_than: int
+        :return: (member ids, number of groups), aligned arrays, sorted by member id
+        """
+        member_ids, _, _ = self.columns
+        unique, counts = np.unique(member_ids, return_counts=True)
+        mask = counts > more_than
+        return unique[mask], counts[mask]
+
+    def save(self, path: Union[str, Path], compress: bool = True) -> None:
+        """
+        Save to a .npz file
+
+        :param path: file path, NumPy appends .npz if missing
+        :param compress: bool, compress the file (smaller, slightly slower to load)
+        """
+        member_ids, group_ids, permissions = self.columns
+        savez = np.savez_compressed if compress else np.savez
+        savez(path, version=np.array(FORMAT_VERSION), member_ids=member_ids, group_ids=group_ids,
+              permissions=permissions)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'Roster':
+        """
+        Load from a file written by Roster.save
+
+        :param path: file path
+        :return: Roster
+        """
+        roster = cls()
+        with np.load(path) as data:
+            if int(data['version']) != FORMAT_VERSION:
+                raise ValueError(f'Unsupported roster file version {int(data["version"])}')
+            member_ids, group_ids, permissions = data['member_ids'], data['group_ids'], data['permissions']
+        # rows are sorted by group id, so each group is a contiguous slice
+        starts = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1]]) if len(group_ids) else []
+        ends = list(starts[1:]) + [len(group_ids)]
+        for start, end in zip(starts, ends):
+            roster._groups[int(group_ids[start])] = (member_ids[start:end], permissions[start:end])
+        roster._columns = (member_ids, group_ids, permissions)
+        roster.logger.debug(f'Loaded {len(member_ids)} memberships of {len(roster._groups)} groups from {path}')
+        return roster
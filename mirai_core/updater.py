@@ -1,27 +1,113 @@
 import asyncio
-from typing import DefaultDict, Union, List, Callable, Any, Awaitable
-from collections import defaultdict
-from dataclasses import dataclass
+import inspect
+import typing
+from typing import DefaultDict, Union, List, Callable, Any, Awaitable, Optional, Dict, Tuple, Type, Set, FrozenSet, Iterable, \
+    TYPE_CHECKING
+from collections import defaultdict, deque
+from collections.abc import MutableMapping, MutableSequence
+from dataclasses import dataclass, field
+from enum import IntEnum
+from io import StringIO
+from itertools import count
 import signal
 from .log import create_logger, install_logger
+from .metrics import Histogram
+from .profiler import HandlerProfiler
+from .resilience import backoff
 from .bot import Bot
-from .models.Event import BaseEvent, Events
+from .models.Event import BaseEvent, Events, Message, MemberJoinRequestEvent
+from .models.Entity import Member, Permission
+from .models.Message import At
+from .models.Types import MessageType
 from .exceptions import SessionException, NetworkException, AuthenticationException, ServerException
 
+if TYPE_CHECKING:  # aiohttp.web is only imported if a webhook is used
+    from .webhook import WebhookReceiver
+
+
+class Priority(IntEnum):
+    """
+    Event priority classes, lower value is served first
+    """
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+# events not listed here are Priority.NORMAL
+DEFAULT_PRIORITIES = {
+    'BotOnlineEvent':                Priority.HIGH,
+    'BotOfflineEventActive':         Priority.HIGH,
+    'BotOfflineEventForce':          Priority.HIGH,
+    'BotOfflineEventDropped':        Priority.HIGH,
+    'BotReloginEvent':               Priority.HIGH,
+    'BotGroupPermissionChangeEvent': Priority.HIGH,
+    'BotMuteEvent':                  Priority.HIGH,
+    'BotUnmuteEvent':                Priority.HIGH,
+    'BotLeaveEventKick':             Priority.HIGH,
+    'NewFriendRequestEvent':         Priority.HIGH,
+    'MemberJoinRequestEvent':        Priority.HIGH,
+    'GroupMessage':                  Priority.LOW,
+    'TempMessage':                   Priority.LOW,
+}
+
 
 class Updater:
-    def __init__(self, bot: Bot, use_websocket: bool = True):
+    def __init__(self, bot: Bot, use_websocket: bool = True, shutdown_timeout: float = 10,
+                 handler_timeout: Optional[float] = None, slow_handler_threshold: Optional[float] = None,
+                 workers: int = 16, shed_threshold: Optional[int] = None, shed_priority: Priority = Priority.LOW,
+                 webhook: Optional['WebhookReceiver'] = None, split_channels: bool = False, event_workers: int = 4,
+                 ordered: bool = True):
         """
         Initialize Updater
 
         :param bot: the Bot object to use
         :param use_websocket: bool. whether websocket (recommended) should be used
+        :param shutdown_timeout: maximum seconds to wait for running handlers and outbound requests on shutdown
+        :param handler_timeout: default seconds before a handler is cancelled, None for no limit
+        :param slow_handler_threshold: default seconds before a handler is logged as slow (with its stack),
+               None to disable
+        :param workers: number of events handled concurrently
+        :param shed_threshold: when this many events are queued, drop incoming events of shed_priority or lower,
+               None to never drop
+        :param shed_priority: Priority, the highest priority class that may be dropped
+        :param webhook: WebhookReceiver, receive events pushed by the webhook adapter instead of websocket or polling
+        :param split_channels: bool, whether messages and other events are received by separate websockets
+               (/message and /event) and handled by separate queues and workers, so a message flood does not delay
+               other events. Each websocket reconnects independently,
+               without a handshake that would replace the session of the other
+        :param event_workers: number of events handled concurrently in the event channel if split_channels is set,
+               workers is used for the message channel
+        :param ordered: bool, whether events of the same conversation (group, or sender of private messages)
+               are handled one at a time in the order they are taken from the queue. Events of different
+               conversations are always handled concurrently. Set to False to handle every event concurrently
         """
         self.bot = bot
         self.loop = bot.loop
         self.logger = create_logger('Updater')
-        self.event_handlers: DefaultDict[Events, List[EventHandler]] = defaultdict(lambda: list())
+        self.handlers: List[EventHandler] = []
+        self._dispatch_table: Optional[Dict[str, Route]] = None
+        self._catch_all = Route([])
         self.use_websocket = use_websocket
+        self.webhook = webhook
+        self.shutdown_timeout = shutdown_timeout
+        self.handler_timeout = handler_timeout
+        self.slow_handler_threshold = slow_handler_threshold
+        self.accepting = True
+        self.priorities: Dict[Union[str, Tuple[str, int]], Priority] = dict(DEFAULT_PRIORITIES)
+        self.workers = workers
+        self.ordered = ordered
+        self.split_channels = split_channels
+        if split_channels:
+            self.channels = {'message': Channel('message', workers), 'event': Channel('event', event_workers)}
+        else:
+            self.channels = {'all': Channel('all', workers)}
+        self.shed_threshold = shed_threshold
+        self.shed_priority = shed_priority
+        self.dropped: DefaultDict[Priority, int] = defaultdict(int)
+        self._sequence = count()
+        self._observer_tasks: Set[asyncio.Task] = set()
+        self.profiler: Optional[HandlerProfiler] = None
 
     async def run_task(self, shutdown_hook: callable = None):
         """
@@ -33,40 +119,125 @@ class Updater:
         tasks = [
             self.handshake()
         ]
-        if not self.use_websocket:
+        if self.webhook is not None:
+            tasks.append(self.webhook.start(self.dispatch))
+        elif not self.use_websocket:
             tasks.append(self.message_polling())
         if shutdown_hook:
             tasks.append(self.raise_shutdown(shutdown_hook))
-        await asyncio.wait(tasks)
+        await asyncio.wait([asyncio.ensure_future(task) for task in tasks])
 
-    def add_handler(self, event: Union[Events, List[Events]]):
+    def add_handler(self, event: Optional[Union[Events, MessageType, str, List[Union[Events, MessageType, str]]]] = None,
+                    timeout: Optional[float] = None, slow_threshold: Optional[float] = None, observer: bool = False,
+                    groups: Optional[Iterable[int]] = None, senders: Optional[Iterable[int]] = None,
+                    permission: Optional[Permission] = None, mention: bool = False):
         """
         Decorator for event listeners
-        Catch all is not supported at this time
+        Handlers subscribed to a base class (Message, BaseEvent) receive all matching event types,
+        BaseEvent subscribes to all events, including types unknown to this library.
+        If event is not set, it is derived from the annotation of the first parameter of the handler
+        (such as event: Message, or event: 'GroupMessage'), TypeError is raised if there is neither.
+        Unknown event type names raise ValueError, subscribe to BaseEvent to receive events unknown to this library.
+        Handlers are called in registration order.
 
-        :param event: events.Events
+        :param event: event class, MessageType or event type name, or a list of them
+        :param timeout: seconds before the handler is cancelled, defaults to Updater.handler_timeout
+        :param slow_threshold: seconds before the handler is logged as slow, defaults to Updater.slow_handler_threshold
+        :param observer: bool, observers run concurrently with the handler chain and cannot stop it,
+               their return values are ignored
+        :param groups: only call the handler for events from these group ids
+        :param senders: only call the handler for events from these qq numbers
+               (sender of messages, member or supplicant of other events)
+        :param permission: Permission, only call the handler if the sender has at least this permission in the group
+        :param mention: bool, only call the handler for messages that mention (At) the bot
         """
         def receiver_wrapper(func):
             if not asyncio.iscoroutinefunction(func):
                 raise TypeError("event body must be a coroutine function.")
 
-            # save function and its parameter types
-            event_handler = EventHandler(func)
-            nonlocal event
-            if not isinstance(event, list):
-                event = [event]
-            for e in event:
-                if e in Events.__args__:
-                    if e.__name__ == 'Message':
-                        self.event_handlers['GroupMessage'].append(event_handler)
-                        self.event_handlers['FriendMessage'].append(event_handler)
-                        self.event_handlers['TempMessage'].append(event_handler)
-                    else:
-                        self.event_handlers[e.__name__].append(event_handler)
+            subscription = event if event is not None else get_annotated_event(func)
+            if subscription is None:
+                raise TypeError(f'{func.__qualname__} has no event and its first parameter is not annotated, '
+                                f'use add_handler(BaseEvent) to subscribe to all events')
+            event_handler = EventHandler(func, timeout=timeout, slow_threshold=slow_threshold, observer=observer,
+                                         events=get_event_types(subscription),
+                                         index=self.handlers[-1].index + 1 if self.handlers else 0,
+                                         groups=frozenset(groups) if groups is not None else None,
+                                         senders=frozenset(senders) if senders is not None else None,
+                                         permission=permission, mention=mention)
+            self.handlers.append(event_handler)
+            self._dispatch_table = None
             return func
 
         return receiver_wrapper
 
+    def compile_handlers(self) -> None:
+        """
+        Build the dispatch table from registered handlers
+        Called automatically on the first event after handlers are added
+        """
+        names = set(EVENT_TYPES)
+        for handler in self.handlers:
+            if handler.events is not None:
+                names.update(handler.events)
+        table = {}
+        for name in names:
+            table[name] = Route([handler for handler in self.handlers
+                                 if handler.events is None or name in handler.events])
+        self._catch_all = Route([handler for handler in self.handlers if handler.events is None])
+        self._dispatch_table = table
+
+    @property
+    def event_handlers(self) -> 'EventHandlerMap':
+        """
+        Handlers of each event type, in registration order
+        Kept for compatibility, changes (such as event_handlers['GroupMessage'].append(EventHandler(func)))
+        are applied to handlers. Prefer add_handler and remove_handler
+        """
+        return EventHandlerMap(self)
+
+    @event_handlers.setter
+    def event_handlers(self, event_handlers: Dict[str, List['EventHandler']]) -> None:
+        self.handlers = []
+        self._dispatch_table = None
+        self.event_handlers.update(event_handlers)
+
+    def remove_handler(self, handler: 'EventHandler') -> None:
+        """
+        Unsubscribe a handler from all events
+
+        :param handler: EventHandler, one of Updater.handlers
+        """
+        self.handlers.remove(handler)
+        self._dispatch_table = None
+
+    def _subscribe(self, handler: 'EventHandler', name: str, before: Optional['EventHandler'] = None) -> None:
+        """
+        Internal use only, subscribe a handler to an event type, see EventHandlerMap
+        A new handler is registered before the given handler, or last
+        """
+        if handler in self.handlers:
+            if handler.events is not None:
+                handler.events = handler.events | {name}
+        else:
+            handler.events = frozenset([name])
+            position = self.handlers.index(before) if before in self.handlers else len(self.handlers)
+            self.handlers.insert(position, handler)
+            for index, registered in enumerate(self.handlers):
+                registered.index = index
+        self._dispatch_table = None
+
+    def _unsubscribe(self, handler: 'EventHandler', name: str) -> None:
+        """
+        Internal use only, unsubscribe a handler from an event type, see EventHandlerMap
+        The handler is removed if it is not subscribed to any other event type
+        """
+        events = frozenset(EVENT_TYPES) if handler.events is None else handler.events
+        handler.events = events - {name}
+        if not handler.events:
+            self.handlers.remove(handler)
+        self._dispatch_table = None
+
     def run(self, log_to_stderr=True) -> None:
         """
         Start the Updater and block the thread
@@ -84,6 +255,7 @@ class Updater:
         try:
             self.loop.add_signal_handler(signal.SIGTERM, _signal_handler)
             self.loop.add_signal_handler(signal.SIGINT, _signal_handler)
+            self.loop.add_signal_handler(signal.SIGUSR2, self.toggle_profiling)
         except (AttributeError, NotImplementedError, RuntimeError):
             pass
 
@@ -96,22 +268,28 @@ class Updater:
     async def handshake(self):
         """
         Internal use only, automatic handshake
-        Called when launch or websocket disconnects
+        Called on launch, websockets of all channels handshake and reconnect by themselves when disconnected
 
         :return:
         """
-        while True:
+        attempt = 0
+        while self.accepting:
             try:
                 await self.bot.handshake()
-                if self.use_websocket:
-                    asyncio.run_coroutine_threadsafe(
-                        self.bot.create_websocket(self.event_caller, self.handshake), self.loop)
+                if self.use_websocket and self.webhook is None:
+                    for name in self.channels:
+                        asyncio.run_coroutine_threadsafe(
+                            self.bot.create_websocket(self.dispatch, listen=name, reconnect=True,
+                                                      handshake=not self.split_channels), self.loop)
                 return True
-            except NetworkException:
-                self.logger.warning('Unable to communicate with Mirai console, retrying in 5 seconds')
+            except NetworkException as e:
+                delay = backoff(attempt, base=1, cap=60)
+                self.logger.warning(f'Unable to communicate with Mirai console ({e}), retrying in {delay:.1f} seconds')
             except Exception as e:
-                self.logger.exception(f'retrying in 5 seconds')
-            await asyncio.sleep(5)
+                delay = backoff(attempt, base=1, cap=60)
+                self.logger.exception(f'retrying in {delay:.1f} seconds')
+            attempt += 1
+            await asyncio.sleep(delay)
 
     async def message_polling(self, count=5, interval=0.5) -> None:
         """
@@ -120,28 +298,270 @@ class Updater:
         :param count: maximum message count for each polling
         :param interval: minimum interval between two polling
         """
-        while True:
+        while self.accepting:
             await asyncio.sleep(interval)
             try:
                 results: List[BaseEvent] = await self.bot.fetch_message(count)
                 if len(results) > 0:
                     self.logger.debug('Received messages:\n' + '\n'.join([str(result) for result in results]))
                 for result in results:
-                    asyncio.run_coroutine_threadsafe(self.event_caller(result), self.loop)
+                    await self.dispatch(result)
             except Exception as e:
                 self.logger.warning(f'{e}, new handshake initiated')
                 await self.handshake()
 
+    def set_priority(self, event: Union[Type[BaseEvent], str], priority: Priority, group: Optional[int] = None):
+        """
+        Set the priority class of an event type
+
+        :param event: event class (Message for all message types) or event type name
+        :param priority: Priority
+        :param group: int, only apply to events from this group
+        """
+        if event is Message:
+            names = [message_type.value for message_type in MessageType]
+        else:
+            names = [event if isinstance(event, str) else event.__name__]
+        for name in names:
+            self.priorities[name if group is None else (name, group)] = priority
+
+    def classify(self, event: BaseEvent) -> Priority:
+        """
+        Get the priority class of an event, group specific priorities take precedence
+
+        :param event: the event
+        :return: Priority
+        """
+        group_id = get_group_id(event)
+        if group_id is not None:
+            priority = self.priorities.get((event.type, group_id))
+            if priority is not None:
+                return priority
+        return self.priorities.get(event.type, Priority.NORMAL)
+
+    async def dispatch(self, event: BaseEvent, done: Optional[asyncio.Future] = None) -> None:
+        """
+        Internal use only, queue the event by priority class for the workers of its channel
+        Incoming events are dropped when the backlog of the channel exceeds shed_threshold
+
+        :param event: the event
+        :param done: future resolved when the handler chain of the event has finished (or the event is dropped)
+        """
+        if not self.accepting:
+            if done is not None:
+                done.set_result(None)
+            return
+        self.bot.prefetch_images(event)
+        channel = self.channel_of(event)
+        if channel.queue is None:
+            channel.queue = asyncio.PriorityQueue()
+            channel.worker_tasks = [asyncio.ensure_future(self._worker(channel)) for _ in range(channel.workers)]
+        priority = self.classify(event)
+        if self.shed_threshold is not None and priority >= self.shed_priority \
+                and channel.backlog >= self.shed_threshold:
+            self.dropped[priority] += 1
+            if done is not None:
+                done.set_result(None)
+            return
+        channel.queue.put_nowait((priority, next(self._sequence), self.loop.time(), event, done))
+
+    def channel_of(self, event: BaseEvent) -> 'Channel':
+        """
+        Get the channel that handles the event
+
+        :param event: the event
+        :return: Channel
+        """
+        if not self.split_channels:
+            return self.channels['all']
+        return self.channels['message' if isinstance(event, Message) else 'event']
+
+    async def _worker(self, channel: 'Channel') -> None:
+        """
+        Internal use only, call event handlers for queued events of the channel, highest priority first
+        If ordered is set, an event of a conversation that another worker is handling waits for that worker,
+        which handles it next
+        """
+        while True:
+            item = await channel.queue.get()
+            if not self.ordered:
+                await self._handle(channel, item)
+                continue
+            key = get_conversation(item[3])
+            waiting = channel.active.get(key)
+            if waiting is not None:
+                waiting.append(item)
+                continue
+            waiting = channel.active[key] = deque()
+            try:
+                await self._handle(channel, item)
+                while waiting:
+                    await self._handle(channel, waiting.popleft())
+            finally:
+                del channel.active[key]
+
+    async def _handle(self, channel: 'Channel', item: tuple) -> None:
+        """
+        Internal use only, call event handlers for an item taken from the queue of the channel
+        """
+        _, _, queued_at, event, done = item
+        channel.lag.observe(self.loop.time() - queued_at)
+        channel.in_progress += 1
+        try:
+            await self.event_caller(event)
+        except Exception:
+            self.logger.exception(f'Unhandled exception in handler for {event.type}')
+        finally:
+            if done is not None and not done.done():
+                done.set_result(None)
+            channel.in_progress -= 1
+            channel.processed += 1
+            channel.queue.task_done()
+
+    @property
+    def backlog(self) -> int:
+        """
+        Number of queued events not yet handled
+        """
+        return sum(channel.backlog for channel in self.channels.values())
+
+    @property
+    def events_processed(self) -> int:
+        """
+        Number of events handled
+        """
+        return sum(channel.processed for channel in self.channels.values())
+
+    def channel_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get backlog and lag (seconds from receiving an event to calling its handlers) of each channel
+
+        :return: dict of channel name to dict of backlog, in_progress, processed and lag (Histogram.snapshot())
+        """
+        return {name: {'backlog': channel.backlog, 'in_progress': channel.in_progress,
+                       'processed': channel.processed, 'lag': channel.lag.snapshot()}
+                for name, channel in self.channels.items()}
+
     async def event_caller(self, event: BaseEvent) -> None:
         """
-        Internal use only, call the event handlers sequentially
+        Internal use only, start the observers, then call the other event handlers sequentially
 
         :param event: the event
         """
-        for handler in self.event_handlers[event.type]:
-            if await handler.func(event):  # if the function returns True, stop calling next event
+        if self._dispatch_table is None:
+            self.compile_handlers()
+        observers, chain = self._dispatch_table.get(event.type, self._catch_all).select(event, self.bot.qq)
+        for handler in observers:
+            task = asyncio.ensure_future(self.call_observer(handler, event))
+            self._observer_tasks.add(task)
+            task.add_done_callback(self._observer_tasks.discard)
+        for handler in chain:
+            if await self.call_handler(handler, event):  # if the function returns True, stop calling next event
                 break
 
+    async def call_observer(self, handler: 'EventHandler', event: BaseEvent) -> None:
+        """
+        Internal use only, call the observer and log its exception
+
+        :param handler: EventHandler
+        :param event: the event
+        """
+        try:
+            await self.call_handler(handler, event)
+        except Exception:
+            self.logger.exception(f'Unhandled exception in observer {handler.name} for {event.type}')
+
+    @property
+    def observers_running(self) -> int:
+        """
+        Number of observer calls not yet finished
+        """
+        return len(self._observer_tasks)
+
+    async def call_handler(self, handler: 'EventHandler', event: BaseEvent) -> Any:
+        """
+        Internal use only, call the handler with deadlines and record its duration
+
+        :param handler: EventHandler
+        :param event: the event
+        :return: the return value of the handler, None if cancelled due to timeout
+        """
+        timeout = self.handler_timeout if handler.timeout is None else handler.timeout
+        slow_threshold = self.slow_handler_threshold if handler.slow_threshold is None else handler.slow_threshold
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        coro = handler.func(event)
+        if self.profiler is not None:
+            coro = self.profiler.wrap(handler.name, coro)
+        try:
+            if timeout is None and slow_threshold is None:
+                return await coro
+
+            task = asyncio.ensure_future(coro)
+            try:
+                if slow_threshold is not None and (timeout is None or slow_threshold < timeout):
+                    done, _ = await asyncio.wait({task}, timeout=slow_threshold)
+                    if not done:
+                        stack = StringIO()
+                        task.print_stack(file=stack)
+                        self.logger.warning(f'Handler {handler.name} is running for more than {slow_threshold}s '
+                                            f'on {event.type}\n{stack.getvalue()}')
+                if timeout is not None:
+                    done, _ = await asyncio.wait({task}, timeout=max(0.0, timeout - (loop.time() - start)))
+                    if not done:
+                        task.cancel()
+                        self.logger.error(f'Handler {handler.name} cancelled after {timeout}s on {event.type}')
+                        return None
+                return await task
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+        finally:
+            handler.durations.observe(loop.time() - start)
+
+    def enable_profiling(self, output_dir: str = 'profiles', window: float = 60,
+                         trace_allocations: bool = False) -> HandlerProfiler:
+        """
+        Start attributing cpu time, wall time and allocations to each handler
+        Can be called at any time, also toggled by SIGUSR2 if started by Updater.run
+
+        :param output_dir: directory for pstats and collapsed stack files
+        :param window: seconds to aggregate before writing results
+        :param trace_allocations: bool, whether to trace allocations with tracemalloc (expensive)
+        :return: HandlerProfiler
+        """
+        if self.profiler is not None:
+            self.profiler.close()
+        self.profiler = HandlerProfiler(output_dir, window, trace_allocations)
+        self.logger.info(f'Profiling enabled, writing to {output_dir} every {window}s')
+        return self.profiler
+
+    def disable_profiling(self) -> None:
+        """
+        Stop profiling and write the remaining results
+        """
+        profiler, self.profiler = self.profiler, None
+        if profiler is not None:
+            path = profiler.close()
+            self.logger.info(f'Profiling disabled, last result: {path}')
+
+    def toggle_profiling(self) -> None:
+        """
+        Enable profiling with default arguments, or disable it if enabled
+        """
+        if self.profiler is None:
+            self.enable_profiling()
+        else:
+            self.disable_profiling()
+
+    def handler_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get duration histograms of all handlers
+
+        :return: dict of handler name to Histogram.snapshot()
+        """
+        return {handler.name: handler.durations.snapshot() for handler in self.handlers}
+
     async def raise_shutdown(self, shutdown_event: Callable[..., Awaitable[None]]) -> None:
         """
         Internal use only, shutdown
@@ -149,21 +569,404 @@ class Updater:
         :param shutdown_event: callable
         """
         await shutdown_event()
-        await self.bot.release()
+        await self.shutdown()
         raise Shutdown()
 
+    async def shutdown(self, timeout: Optional[float] = None) -> 'ShutdownReport':
+        """
+        Graceful shutdown
+        Stop receiving events, wait for running handlers and outbound requests until the deadline,
+        then cancel the rest, release the session and close the http client
+
+        :param timeout: maximum seconds to wait, defaults to shutdown_timeout
+        :return: ShutdownReport
+        """
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        deadline = self.loop.time() + timeout
+        self.accepting = False
+        if self.webhook is not None:
+            await self.webhook.stop()
+        await self.bot.session.close_websockets()
+
+        report = ShutdownReport()
+        requests_completed = self.bot.session.requests_completed
+        events_processed = self.events_processed
+        queues = [channel.queue.join() for channel in self.channels.values() if channel.queue is not None]
+        if queues:
+            try:
+                await asyncio.wait_for(asyncio.gather(*queues), timeout)
+            except asyncio.TimeoutError:
+                pass
+        for channel in self.channels.values():
+            report.events_abandoned += channel.backlog + channel.in_progress
+            for task in channel.worker_tasks:
+                task.cancel()
+        report.events_completed = self.events_processed - events_processed
+        if self._observer_tasks:
+            observers = set(self._observer_tasks)
+            _, pending = await asyncio.wait(observers, timeout=max(0.0, deadline - self.loop.time()))
+            report.observers_completed = len(observers) - len(pending)
+            report.observers_abandoned = len(pending)
+            for task in pending:
+                task.cancel()
+        await self.bot.session.wait_idle(max(0.0, deadline - self.loop.time()))
+        report.requests_completed = self.bot.session.requests_completed - requests_completed
+        report.requests_abandoned = self.bot.session.requests_in_flight
+        self.logger.info(f'Shutdown: {report}')
+        self.disable_profiling()  # write the last window
+
+        try:
+            await self.bot.release()
+        except Exception:
+            self.logger.exception('Unable to release session')
+        await self.bot.session.close()
+        return report
+
     def handle_exception(self, loop, context):
         # context["message"] will always be there; but context["exception"] may not
         msg = context.get("exception", context["message"])
         self.logger.exception('Unhandled exception: ', exc_info=msg)
 
 
+@dataclass
+class ShutdownReport:
+    """
+    Counts of work completed and abandoned during graceful shutdown
+    """
+    events_completed: int = 0
+    events_abandoned: int = 0
+    requests_completed: int = 0
+    requests_abandoned: int = 0
+    observers_completed: int = 0
+    observers_abandoned: int = 0
+
+
+class Channel:
+    """
+    Internal use only
+    Queue and workers of one websocket channel ('all', 'message' or 'event')
+    """
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.worker_tasks: List[asyncio.Task] = []
+        self.active: Dict[Any, deque] = {}  # conversation being handled to queue items waiting for it
+        self.in_progress = 0
+        self.processed = 0
+        self.lag = Histogram()
+
+    @property
+    def backlog(self) -> int:
+        waiting = sum(len(items) for items in self.active.values())
+        return waiting + (self.queue.qsize() if self.queue is not None else 0)
+
+
 @dataclass
 class EventHandler:
     """
     Contains the callback function
     """
     func: Callable
+    timeout: Optional[float] = None
+    slow_threshold: Optional[float] = None
+    observer: bool = False
+    events: Optional[FrozenSet[str]] = None  # subscribed event type names, None for all events
+    index: int = 0  # registration order
+    groups: Optional[FrozenSet[int]] = None
+    senders: Optional[FrozenSet[int]] = None
+    permission: Optional[Permission] = None
+    mention: bool = False
+    durations: Histogram = field(default_factory=Histogram)
+
+    @property
+    def name(self) -> str:
+        return f'{self.func.__module__}.{self.func.__qualname__}'
+
+    @property
+    def checked(self) -> bool:
+        """
+        Whether the handler has filters not covered by the group or sender index
+        """
+        return (self.groups is not None and self.senders is not None) or self.permission is not None or self.mention
+
+    def accepts(self, event: BaseEvent, qq: int) -> bool:
+        """
+        Internal use only, check filters not covered by the group or sender index
+
+        :param event: the event
+        :param qq: qq number of the bot, for mention filter
+        :return: bool
+        """
+        if self.groups is not None and self.senders is not None and get_sender_id(event) not in self.senders:
+            return False
+        if self.permission is not None:
+            member = event.member if isinstance(event, Message) else getattr(event, 'member', None)
+            if not isinstance(member, Member) or \
+                    PERMISSION_LEVELS[member.permission] < PERMISSION_LEVELS[self.permission]:
+                return False
+        if self.mention:
+            if not isinstance(event, Message):
+                return False
+            if not any(isinstance(component, At) and component.target == qq for component in event.messageChain):
+                return False
+        return True
+
+
+class Route:
+    """
+    Internal use only
+    Handlers of one event type, handlers filtered by groups or senders are indexed by group id or sender id
+    """
+    __slots__ = ('handlers', 'observers', 'chain', 'base', 'by_group', 'by_sender', 'checked')
+
+    def __init__(self, handlers: List[EventHandler]):
+        self.handlers = tuple(handlers)
+        self.base = tuple(handler for handler in handlers if handler.groups is None and handler.senders is None)
+        self.observers, self.chain = self.split(self.base)
+        by_group: DefaultDict[int, List[EventHandler]] = defaultdict(list)
+        by_sender: DefaultDict[int, List[EventHandler]] = defaultdict(list)
+        for handler in handlers:
+            if handler.groups is not None:
+                for group_id in handler.groups:
+                    by_group[group_id].append(handler)
+            elif handler.senders is not None:
+                for sender_id in handler.senders:
+                    by_sender[sender_id].append(handler)
+        self.by_group = {group_id: tuple(group_handlers) for group_id, group_handlers in by_group.items()}
+        self.by_sender = {sender_id: tuple(sender_handlers) for sender_id, sender_handlers in by_sender.items()}
+        self.checked = any(handler.checked for handler in handlers)
+
+    @staticmethod
+    def split(handlers: Iterable[EventHandler]) -> Tuple[Tuple[EventHandler, ...], Tuple[EventHandler, ...]]:
+        """
+        Split handlers into observers and the handler chain
+        """
+        return (tuple(handler for handler in handlers if handler.observer),
+                tuple(handler for handler in handlers if not handler.observer))
+
+    def select(self, event: BaseEvent, qq: int) -> Tuple[Tuple[EventHandler, ...], Tuple[EventHandler, ...]]:
+        """
+        Select the handlers applicable to the event, in registration order
+
+        :param event: the event
+        :param qq: qq number of the bot, for mention filter
+        :return: (observers, handler chain)
+        """
+        handlers = self.base
+        indexed = ()
+        if self.by_group:
+            indexed = self.by_group.get(get_group_id(event), ())
+        if self.by_sender:
+            sender_handlers = self.by_sender.get(get_sender_id(event), ())
+            indexed = indexed + sender_handlers if indexed else sender_handlers
+        if indexed:
+            handlers = sorted(handlers + indexed, key=lambda handler: handler.index)
+        elif not self.checked:
+            return self.observers, self.chain
+        if self.checked:
+            handlers = [handler for handler in handlers if not handler.checked or handler.accepts(event, qq)]
+        return self.split(handlers)
+
+
+class EventHandlerList(MutableSequence):
+    """
+    Handlers of an event type, see Updater.event_handlers
+    """
+
+    def __init__(self, updater: Updater, name: str):
+        self.updater = updater
+        self.name = name
+
+    def _handlers(self) -> List[EventHandler]:
+        return [handler for handler in self.updater.handlers if handler.events is None or self.name in handler.events]
+
+    def __getitem__(self, index):
+        return self._handlers()[index]
+
+    def __len__(self) -> int:
+        return len(self._handlers())
+
+    def __setitem__(self, index, handler) -> None:
+        if isinstance(index, slice):
+            raise TypeError('slice assignment is not supported')
+        previous = self._handlers()[index]
+        if previous is not handler:
+            self.updater._subscribe(handler, self.name, before=previous)
+            self.updater._unsubscribe(previous, self.name)
+
+    def __delitem__(self, index) -> None:
+        handlers = self._handlers()[index]
+        for handler in handlers if isinstance(index, slice) else [handlers]:
+            self.updater._unsubscribe(handler, self.name)
+
+    def insert(self, index: int, handler: EventHandler) -> None:
+        handlers = self._handlers()
+        before = handlers[index] if -len(handlers) <= index < len(handlers) else None
+        self.updater._subscribe(handler, self.name, before=before)
+
+    def __eq__(self, other) -> bool:
+        return self._handlers() == list(other) if isinstance(other, (list, EventHandlerList)) else NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(self._handlers())
+
+
+class EventHandlerMap(MutableMapping):
+    """
+    Event type name to EventHandlerList, see Updater.event_handlers
+    Like a defaultdict, missing event types are empty lists
+    """
+
+    def __init__(self, updater: Updater):
+        self.updater = updater
+
+    def __getitem__(self, name: str) -> EventHandlerList:
+        return EventHandlerList(self.updater, name)
+
+    def __setitem__(self, name: str, handlers: List[EventHandler]) -> None:
+        handlers = list(handlers)
+        del self[name]
+        self[name].extend(handlers)
+
+    def __delitem__(self, name: str) -> None:
+        for handler in list(self[name]):
+            self.updater._unsubscribe(handler, name)
+
+    def _names(self) -> List[str]:
+        updater = self.updater
+        if updater._dispatch_table is None:
+            updater.compile_handlers()
+        return [name for name, route in updater._dispatch_table.items() if route.handlers]
+
+    def __iter__(self):
+        return iter(self._names())
+
+    def __len__(self) -> int:
+        return len(self._names())
+
+    def __repr__(self) -> str:
+        return repr({name: self[name] for name in self})
+
+
+def _event_types() -> Dict[str, Type[BaseEvent]]:
+    """
+    Internal use only, map event type names to event classes
+    """
+    types = {}
+    for event_type in Events.__args__:
+        if event_type is Message:
+            for message_type in MessageType:
+                types[message_type.value] = Message
+        elif issubclass(event_type, BaseEvent) and event_type is not BaseEvent:
+            types[event_type.__name__] = event_type
+    return types
+
+
+EVENT_TYPES = _event_types()
+PERMISSION_LEVELS = {Permission.Member: 0, Permission.Administrator: 1, Permission.Owner: 2}
+EVENT_CLASSES = {event_type.__name__: event_type for event_type in Events.__args__}
+
+
+def get_event_types(event: Any) -> Optional[FrozenSet[str]]:
+    """
+    Get the event type names matched by a subscription
+
+    :param event: event class, MessageType, event type name, list or Union of them, None or BaseEvent for all events
+    :return: frozenset of event type names, None for all events
+    """
+    if event is None or event is BaseEvent:
+        return None
+    if isinstance(event, MessageType):
+        return frozenset([event.value])
+    if isinstance(event, str):
+        if event in EVENT_TYPES:
+            return frozenset([event])
+        if event in EVENT_CLASSES:  # string annotation of a base class
+            return get_event_types(EVENT_CLASSES[event])
+        raise ValueError(f'Unknown event type: {event}, subscribe to BaseEvent to receive events '
+                         f'unknown to this library')
+    if isinstance(event, (list, tuple)) or getattr(event, '__origin__', None) is Union:
+        names = set()
+        for e in (event if isinstance(event, (list, tuple)) else event.__args__):
+            if e is type(None):
+                continue
+            e_names = get_event_types(e)
+            if e_names is None:
+                return None
+            names.update(e_names)
+        return frozenset(names)
+    if isinstance(event, type) and issubclass(event, BaseEvent):
+        return frozenset(name for name, event_type in EVENT_TYPES.items() if issubclass(event_type, event))
+    raise ValueError(f'Invalid event: {event}')
+
+
+def get_annotated_event(func: Callable) -> Any:
+    """
+    Get the annotation of the first parameter of the handler
+
+    :param func: the handler
+    :return: the annotation, or None if not annotated
+    """
+    parameters = list(inspect.signature(func).parameters.values())
+    if not parameters or parameters[0].annotation is inspect.Parameter.empty:
+        return None
+    try:
+        return typing.get_type_hints(func)[parameters[0].name]
+    except Exception:  # unresolvable forward reference, such as 'GroupMessage'
+        return parameters[0].annotation
+
+
+def get_sender_id(event: BaseEvent) -> Optional[int]:
+    """
+    Get the qq number of the sender of a message, or the member or supplicant of other events
+
+    :param event: the event
+    :return: int or None
+    """
+    if isinstance(event, Message):
+        return event.sender.id
+    member = getattr(event, 'member', None)
+    if member is not None:
+        return member.id
+    return getattr(event, 'supplicant', None)
+
+
+def get_conversation(event: BaseEvent) -> Tuple[str, Optional[int]]:
+    """
+    Get the key of the conversation of the event, events of one conversation are handled in order
+
+    :param event: the event
+    :return: ('group', group id), ('private', qq number), or ('bot', None) for events of neither
+    """
+    group_id = get_group_id(event)
+    if group_id is not None:
+        return 'group', group_id
+    sender_id = get_sender_id(event)
+    if sender_id is not None:
+        return 'private', sender_id
+    return 'bot', None
+
+
+def get_group_id(event: BaseEvent) -> Optional[int]:
+    """
+    Get the group id of the event, if any
+
+    :param event: the event
+    :return: int or None
+    """
+    if isinstance(event, Message):
+        return event.sender.group.id if isinstance(event.sender, Member) else None
+    group = getattr(event, 'group', None)
+    if group is not None:
+        return group.id
+    member = getattr(event, 'member', None) or getattr(event, 'operator', None)
+    if isinstance(member, Member):
+        return member.group.id
+    if isinstance(event, MemberJoinRequestEvent):
+        return event.sourceGroup
+    return None
 
 
 class Shutdown(Exception):
@@ -0,0 +1,147 @@
+from typing import Dict, Optional, Callable, Awaitable, Union, List
+import asyncio
+from aiohttp import web
+from .log import create_logger
+from .bot import Bot
+from .models.Event import BaseEvent, Message
+from .models.Message import MessageChain, BaseMessageComponent, BotMessage
+from .models.Template import RenderedMessage
+from .models.Types import MessageType
+
+
+class WebhookReceiver:
+    """
+    Receive events pushed by mirai-api-http webhook adapter
+
+    Events are parsed by the same path as websocket events and dispatched to the Updater.
+    Handlers may answer a message within the webhook response by WebhookReceiver.reply,
+    which saves a request to the console.
+
+    Example:
+        webhook = WebhookReceiver(bot, port=8081)
+        updater = Updater(bot, webhook=webhook)
+
+        @updater.add_handler(Message)
+        async def handler(event):
+            await webhook.reply(event, 'pong')
+    """
+
+    def __init__(self, bot: Bot, host: str = '0.0.0.0', port: int = 8081, path: str = '/',
+                 token: Optional[str] = None, reply_timeout: float = 1):
+        """
+        Initialize WebhookReceiver
+
+        :param bot: the Bot object to use
+        :param host: address to listen on
+        :param port: port to listen on
+        :param path: url path configured as webhook destination
+        :param token: if set, requests must have this value in Authorization header
+               (configure it as extra header of the webhook adapter)
+        :param reply_timeout: seconds to wait for a handler reply before responding without command
+        """
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.path = path
+        self.token = token
+        self.reply_timeout = reply_timeout
+        self.logger = create_logger('Webhook')
+        self.received = 0
+        self.replied = 0
+        self._dispatch: Optional[Callable[..., Awaitable[None]]] = None
+        self._replies: Dict[int, asyncio.Future] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, dispatch: Callable[..., Awaitable[None]]) -> None:
+        """
+        Start the http server
+
+        :param dispatch: Updater.dispatch
+        """
+        self._dispatch = dispatch
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.logger.info(f'Webhook listening on {self.host}:{self.port}{self.path}')
+
+    async def stop(self) -> None:
+        """
+        Stop the http server
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """
+        Internal use only, parse and dispatch the pushed event, then respond with the reply command if any
+
+        :param request: the webhook request
+        :return: the response
+        """
+        if self.token is not None and request.headers.get('Authorization') != self.token:
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        self.received += 1
+        event = self.bot._parse_event({'syncId': '-1', 'data': data})
+        if event is None or self._dispatch is None:
+            return web.Response(status=204)
+
+        loop = asyncio.get_event_loop()
+        reply = loop.create_future()
+        done = loop.create_future()
+        self._replies[id(event)] = reply
+        try:
+            await self._dispatch(event, done)
+            await asyncio.wait({reply, done}, timeout=self.reply_timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            del self._replies[id(event)]
+        if reply.done():
+            self.replied += 1
+            return web.json_response(reply.result())
+        reply.cancel()
+        return web.Response(status=204)
+
+    async def reply(self, event: Message,
+                    message: Union[MessageChain, BaseMessageComponent, List[BaseMessageComponent],
+                                   RenderedMessage, str],
+                    quote: bool = False) -> Optional[BotMessage]:
+        """
+        Reply to the sender of the message, in the webhook response if it is still pending,
+        otherwise by Bot.send_message
+
+        :param event: the message to reply to
+        :param message: the content to send, see Bot.send_message
+        :param quote: bool, whether to quote the message
+        :return: None if replied in webhook response (message id is not available), otherwise BotMessage
+        """
+        if event.type == MessageType.GROUP:
+            target = event.sender.group
+        else:
+            target = event.sender
+        quote_source = event.messageChain.get_source() if quote else None
+        future = self._replies.get(id(event))
+        if future is None or future.done():
+            return await self.bot.send_message(target, event.type, message, quote_source=quote_source)
+        portal, data = await self.bot._build_message(target, event.type, message, quote_source=quote_source)
+        if future.done():  # webhook response was sent while uploading images
+            result = await self.bot.session.post(portal, data=data, idempotent=self.bot.retry_sends)
+            return BotMessage.parse_obj(result)
+        data.pop('sessionKey', None)
+        future.set_result({'command': portal.lstrip('/'), 'content': data})
+        return None
+
+    def pending(self, event: BaseEvent) -> bool:
+        """
+        Check whether the webhook response of the event has not been sent
+
+        :param event: the event
+        :return: bool
+        """
+        future = self._replies.get(id(event))
+        return future is not None and not future.done()
@@ -32,6 +32,10 @@ setup(
         "aiohttp",
         "pydantic==1.7.4"
     ],
+    extras_require={
+        "image": ["Pillow"],
+        "roster": ["numpy"]
+    },
     long_description=long_description,
     long_description_content_type="text/markdown",
     classifiers = [